@@ -1,31 +1,55 @@
-from PyQt5.QtCore import QEvent, Qt, pyqtSignal, QObject
+from PyQt5.QtCore import QEvent, Qt, pyqtSignal, QObject, QAbstractListModel, QModelIndex, QTimer, QStringListModel
 from PyQt5.QtGui import QMouseEvent, QFont
-from PyQt5.QtWidgets import QMainWindow, QApplication, QLabel, QSpacerItem, QSizePolicy, QStackedWidget, QWidget, QVBoxLayout, QHBoxLayout
+from PyQt5.QtWidgets import QMainWindow, QApplication, QLabel, QSpacerItem, QSizePolicy, QStackedWidget, QWidget, QVBoxLayout, QListWidgetItem, QCompleter
 
-from threading import Thread
-from typing import Literal
+from concurrent.futures import Future
+from threading import Thread, Lock, Event
+from queue import Queue, Empty
+from typing import Any, Callable
 import socket
-import sys
 import json
+import sys
+import os
 
 import view.ChatPage as ChatPage
 import view.AccessPage as AccessPage
 import view.AddFriendPage as AddFriendPage
 
-from Database import Database
+from Database import Database, DatabaseWorker
+from Protocol import FrameDecoder, encode
+from Log import getLogger, setupLogging
+
+# Last session token, so a restarted client goes straight back to its chats
+SESSION_PATH = "session.json"
+# The client runs without a console, so log records go to a file
+LOG_PATH = "client.log"
+
+log = getLogger("Client")
 
 
 class WorkingSignals(QObject):
     message_received = pyqtSignal()
-    user_login = pyqtSignal(str)
-    user_register = pyqtSignal(str)
+    user_login = pyqtSignal(str, str)
+    user_register = pyqtSignal(str, str)
+    user_resume = pyqtSignal(str, str, str)
+    connection_lost = pyqtSignal()
+    storage_done = pyqtSignal(object, object)
+    user_search = pyqtSignal(str, list)
+    user_exists = pyqtSignal(str, bool)
+    group_joined = pyqtSignal(str, str, str)
 
 
 class FriendLabel(QLabel):
-    def __init__(self, app, text):
-        super().__init__(text)
+    def __init__(self, app, conversation: dict):
+        super().__init__()
         self.app: ChatPageApp = app
-        self.friend_username = text
+        self.friend_username: str = conversation["username"]
+        if conversation["unread"]:
+            self.setText(f"{self.friend_username} ({conversation['unread']})")
+        else:
+            self.setText(self.friend_username)
+        if conversation["last_message"] is not None:
+            self.setToolTip(conversation["last_message"])
 
     def mouseDoubleClickEvent(self, event):
         self.app.refreshChat(self.friend_username)
@@ -41,36 +65,159 @@ class FriendLabel(QLabel):
         self.setFont(font)
 
 
-class MessageWidget(QWidget):
-    def __init__(self, app, type: Literal["sent", "received"], message: str):
+class MessagesModel(QAbstractListModel):
+    # Holds a window of at most max_rows messages of the open conversation and
+    # pages more in from the Database as the view scrolls; QListView only does
+    # rendering work for the rows that are visible. Pages are read on the
+    # DatabaseWorker and applied when they arrive, one load at a time
+    def __init__(self, app, page_size: int = 200, max_rows: int = 2000):
         super().__init__()
-        self.app = app
-        self.message = message
-
-        layout = QHBoxLayout()
-        self.setLayout(layout)
-        layout.setContentsMargins(0, 0, 0, 0)
-
-        label = QLabel(message)
+        self.app: ChatPageApp = app
+        self.view = app.chatPage.messagesView
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.conversation: str = ""
+        self.messages: list[dict] = []
+        self.has_older = False
+        # True once the newest rows were trimmed while scrolling back in history
+        self.has_newer = False
+        self.loading = False
+        self.newer_pending = False
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.messages)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message: dict = self.messages[index.row()]
+        if role == Qt.DisplayRole:
+            return message["message"]
+        if role == Qt.TextAlignmentRole:
+            if message["sender_username"] == self.app.username:
+                return int(Qt.AlignRight | Qt.AlignVCenter)
+            return int(Qt.AlignLeft | Qt.AlignVCenter)
+        if role == Qt.ToolTipRole:
+            return message["timestamp"]
+        return None
+
+    def openConversation(self, conversation: str):
+        self.conversation = conversation
+        self.beginResetModel()
+        self.messages = []
+        self.has_older = False
+        self.has_newer = False
+        self.endResetModel()
+
+        self.loading = True
+        self.newer_pending = False
+        self.app.runStorage(Database.getMessagesBefore, conversation, None, self.page_size,
+                            callback=lambda messages: self.conversationLoaded(conversation, messages))
+
+    def conversationLoaded(self, conversation: str, messages: list[dict]):
+        if conversation != self.conversation:
+            return
+        self.beginResetModel()
+        self.messages = messages
+        self.has_older = len(messages) == self.page_size
+        self.endResetModel()
+        self.view.scrollToBottom()
+        self.loadFinished()
+
+    def loadOlder(self):
+        if self.loading or not self.has_older or not self.messages:
+            return
+        self.loading = True
+        conversation = self.conversation
+        self.app.runStorage(Database.getMessagesBefore, conversation, self.messages[0]["id"], self.page_size,
+                            callback=lambda messages: self.olderLoaded(conversation, messages))
 
-        if type == "sent":
-            layout.addStretch()
-            layout.addWidget(label)
-        elif type == "received":
-            layout.addWidget(label)
-            layout.addStretch()
+    def olderLoaded(self, conversation: str, older: list[dict]):
+        if conversation != self.conversation:
+            return
+        self.has_older = len(older) == self.page_size
+        if older:
+            scroll_bar = self.view.verticalScrollBar()
+            value: int = scroll_bar.value()
+
+            self.beginInsertRows(QModelIndex(), 0, len(older) - 1)
+            self.messages[0:0] = older
+            self.endInsertRows()
+
+            extra = len(self.messages) - self.max_rows
+            if extra > 0:
+                self.beginRemoveRows(QModelIndex(), len(self.messages) - extra, len(self.messages) - 1)
+                del self.messages[-extra:]
+                self.endRemoveRows()
+                self.has_newer = True
+
+            # Keep the rows the user was looking at in place
+            scroll_bar.setValue(value + len(older))
+        self.loadFinished()
+
+    def loadNewer(self):
+        if self.loading:
+            self.newer_pending = True
+            return
+        self.loading = True
+        self.newer_pending = False
+        conversation = self.conversation
+        after_id: int = self.messages[-1]["id"] if self.messages else 0
+        limit = self.page_size if self.has_newer else -1
+        self.app.runStorage(Database.getMessages, conversation, after_id, limit,
+                            callback=lambda messages: self.newerLoaded(conversation, messages))
+
+    def newerLoaded(self, conversation: str, newer: list[dict]):
+        if conversation != self.conversation:
+            return
+        if self.has_newer:
+            self.has_newer = len(newer) == self.page_size
+        if newer:
+            scroll_bar = self.view.verticalScrollBar()
+            value: int = scroll_bar.value()
+            at_bottom: bool = value == scroll_bar.maximum()
+
+            self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages) + len(newer) - 1)
+            self.messages.extend(newer)
+            self.endInsertRows()
+
+            extra = len(self.messages) - self.max_rows
+            if extra > 0:
+                self.beginRemoveRows(QModelIndex(), 0, extra - 1)
+                del self.messages[:extra]
+                self.endRemoveRows()
+                self.has_older = True
+
+            if at_bottom:
+                self.view.scrollToBottom()
+            elif extra > 0:
+                scroll_bar.setValue(value - extra)
+        self.loadFinished()
+
+    def loadFinished(self):
+        self.loading = False
+        # New messages arrived while another page was loading
+        if self.newer_pending:
+            self.loadNewer()
 
 
 class ChatPageApp(QMainWindow):
     def __init__(self, ip: str, port: int):
         super().__init__()
         self.username: str = ""
+        self.log = log.bind(lambda: {"user": self.username or None})
         self.open_chat_username: str = ""
-        self.database: Database
+        self.friendLabels: list[FriendLabel] = []
         self.signals = WorkingSignals()
         self.ip, self.port = ip, port
-        self.database = Database()
-        self.connect()
+        self.send_lock = Lock()
+        self.storage = DatabaseWorker()
+        self.storage.start()
+        self.token: str = ""
+        self.closing = False
+        self.reconnect_delay = 1000
 
         self.setWindowTitle("ChatRoom - Client")
 
@@ -82,6 +229,14 @@ class ChatPageApp(QMainWindow):
         self.chatPage = ChatPage.Ui_ChatPage()
         self.chatPage.setupUi(self.chatPageWidget)
         self.stacked_widget.addWidget(self.chatPageWidget)
+        self.messagesModel = MessagesModel(self)
+        self.chatPage.messagesView.setModel(self.messagesModel)
+        self.chatPage.searchResultsList.setVisible(False)
+
+        # Search runs once typing pauses, not on every keystroke
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(200)
 
         # Setup Access Page
         self.accessPageWidget = QWidget()
@@ -95,20 +250,39 @@ class ChatPageApp(QMainWindow):
         self.addFriendPage.setupUi(self.addFriendPageWidget)
         self.stacked_widget.addWidget(self.addFriendPageWidget)
 
+        # Usernames are completed from the server's user directory
+        self.userSearchModel = QStringListModel(self)
+        self.userCompleter = QCompleter(self.userSearchModel, self)
+        self.userCompleter.setCaseSensitivity(Qt.CaseSensitive)
+        self.addFriendPage.addFriendUsernameInput.setCompleter(self.userCompleter)
+        self.userSearchTimer = QTimer(self)
+        self.userSearchTimer.setSingleShot(True)
+        self.userSearchTimer.setInterval(200)
+
         # Open Access Page first
         self.openAccessPage()
 
         self.clientReceive: ClientReceive
 
         # Signals Connections
-        self.signals.message_received.connect(lambda: self.refreshChat(self.open_chat_username))
+        self.signals.message_received.connect(self.receiveMessages)
         self.signals.user_login.connect(self.login)
         self.signals.user_register.connect(self.register)
+        self.signals.user_resume.connect(self.resume)
+        self.signals.connection_lost.connect(self.connectionLost)
+        self.signals.storage_done.connect(self.storageDone)
+        self.signals.user_search.connect(self.showUserSearch)
+        self.signals.user_exists.connect(self.userExists)
+        self.signals.group_joined.connect(self.groupJoined)
 
         # Chat Page Buttons Bindings
         self.chatPage.addFriendButton.clicked.connect(self.openAddFriendPage)
         self.chatPage.sendMessageButton.clicked.connect(lambda: self.sendMessage(self.chatPage.messageLineEdit.text()))
         self.chatPage.changeAccountAction.triggered.connect(lambda: self.openAccessPage())
+        self.chatPage.messagesView.verticalScrollBar().valueChanged.connect(self.messagesScrolled)
+        self.chatPage.searchLineEdit.textChanged.connect(lambda: self.searchTimer.start())
+        self.searchTimer.timeout.connect(self.searchRequest)
+        self.chatPage.searchResultsList.itemDoubleClicked.connect(lambda item: self.refreshChat(item.data(Qt.UserRole)))
 
         # Access Page Buttons Bindings
         self.accessPage.loginButton.clicked.connect(self.loginRequest)
@@ -116,19 +290,83 @@ class ChatPageApp(QMainWindow):
 
         # AddFriend Page Buttons Bindings
         self.addFriendPage.addFriendButton.clicked.connect(self.addFriend)
+        self.addFriendPage.addFriendUsernameInput.textEdited.connect(lambda: self.userSearchTimer.start())
+        self.userSearchTimer.timeout.connect(self.userSearchRequest)
+
+        self.loadSession()
+        self.reconnect()
 
     def connect(self):
         self.socket = socket.socket()
         self.socket.connect((self.ip, self.port))
 
-        self.clientReceive = ClientReceive(self, self.socket, self.database, self.signals)
+        self.clientReceive = ClientReceive(self, self.socket, self.signals)
         self.clientReceive.start()
 
+    def reconnect(self):
+        if self.closing:
+            return
+        try:
+            self.connect()
+        except OSError as e:
+            self.log.warning("connect_failed", error=str(e), retry_ms=self.reconnect_delay)
+            self.connectionLost()
+            return
+
+        self.reconnect_delay = 1000
+        # A saved token logs back in without the password
+        if self.token:
+            self.send({
+                "type": "resume",
+                "token": self.token
+            })
+
+    def connectionLost(self):
+        # Retries with a growing delay, up to 30 seconds
+        if self.closing:
+            return
+        QTimer.singleShot(self.reconnect_delay, self.reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, 30000)
+
+    def send(self, message: dict):
+        # Keeps frames from different threads from interleaving on the socket
+        try:
+            with self.send_lock:
+                self.socket.sendall(encode(message))
+        except OSError as e:
+            self.log.warning("send_failed", error=str(e), type=message.get("type"))
+
+    def loadSession(self):
+        try:
+            with open(SESSION_PATH) as file:
+                self.token = json.load(file)["token"]
+        except (OSError, ValueError, KeyError):
+            self.token = ""
+
+    def saveSession(self, token: str):
+        self.token = token
+        try:
+            with open(SESSION_PATH, "w") as file:
+                json.dump({"token": token}, file)
+        except OSError as e:
+            self.log.error("session_save_failed", path=SESSION_PATH, error=str(e))
+
+    def clearSession(self):
+        self.token = ""
+        try:
+            os.remove(SESSION_PATH)
+        except OSError:
+            pass
+
     def openChatPage(self):
         self.stacked_widget.setCurrentWidget(self.chatPageWidget)
 
     def openAccessPage(self):
+        if self.username:
+            self.send({"type": "logout"})
+            self.clearSession()
         self.username = ""
+        self.showConversations([])
         self.setWindowTitle("ChatRoom - Client")
         self.stacked_widget.setCurrentWidget(self.accessPageWidget)
 
@@ -139,26 +377,30 @@ class ChatPageApp(QMainWindow):
         self.username = self.accessPage.loginUsernameInput.text()
         password = self.accessPage.loginPasswordInput.text()
 
-        self.database.setDatabase(self.username)
+        self.runStorage(Database.setDatabase, self.username)
 
         loginMessage: dict = {
             "type": "login",
             "username": self.username,
             "password": password
         }
-        self.socket.send(json.dumps(loginMessage).encode())
+        self.send(loginMessage)
 
-    def login(self, check: str):
+    def login(self, check: str, token: str):
         if (check == "success"):
+            self.saveSession(token)
             self.accessPage.loginStatusLabel.setText("Login successful!")
             self.stacked_widget.setCurrentWidget(self.chatPageWidget)
             self.username = self.accessPage.loginUsernameInput.text()
             self.setWindowTitle(f"ChatRoom - Client ({self.username})")
+            self.loadConversations()
 
             self.accessPage.loginUsernameInput.setText("")
             self.accessPage.loginPasswordInput.setText("")
         elif (check == "failure"):
             self.accessPage.loginStatusLabel.setText("Invalid username or password!")
+        elif (check == "busy"):
+            self.accessPage.loginStatusLabel.setText("Server is busy, try again in a moment!")
 
     def registerRequest(self):
         self.username = self.accessPage.registerUsernameInput.text()
@@ -166,26 +408,45 @@ class ChatPageApp(QMainWindow):
         confirm_password = self.accessPage.registerPasswordConfirmInput.text()
 
         if (password == confirm_password):
-            self.database.setDatabase(self.username)
+            self.runStorage(Database.setDatabase, self.username)
             registerMessage: dict = {
                 "type": "register",
                 "username": self.username,
                 "password": password
             }
-            self.socket.send(json.dumps(registerMessage).encode())
+            self.send(registerMessage)
 
-    def register(self, check: str):
+    def register(self, check: str, token: str):
         if (check == "success"):
+            self.saveSession(token)
             self.accessPage.registerStatusLabel.setText("Registration successful!")
             self.stacked_widget.setCurrentWidget(self.chatPageWidget)
             self.username = self.accessPage.registerUsernameInput.text()
             self.setWindowTitle(f"ChatRoom - Client ({self.username})")
+            self.loadConversations()
 
             self.accessPage.registerUsernameInput.setText("")
             self.accessPage.registerPasswordInput.setText("")
             self.accessPage.registerPasswordConfirmInput.setText("")
         elif (check == "failure"):
             self.accessPage.registerStatusLabel.setText("Username already exists!")
+        elif (check == "busy"):
+            self.accessPage.registerStatusLabel.setText("Server is busy, try again in a moment!")
+
+    def resume(self, check: str, username: str, token: str):
+        if (check == "success"):
+            # Already on the chat page after a reconnect; only a fresh start needs opening it
+            if username != self.username:
+                self.username = username
+                self.runStorage(Database.setDatabase, self.username)
+                self.setWindowTitle(f"ChatRoom - Client ({self.username})")
+                self.stacked_widget.setCurrentWidget(self.chatPageWidget)
+            self.loadConversations()
+        elif (check == "failure"):
+            # Expired or revoked, so the user has to log in again
+            self.clearSession()
+            if self.username:
+                self.openAccessPage()
 
     def addFriend(self):
         friend_username: str = self.addFriendPage.addFriendUsernameInput.text()
@@ -195,88 +456,256 @@ class ChatPageApp(QMainWindow):
             self.addFriendPage.addFriendStatusLabel.setText("You cannot add yourself as a friend!")
             return
 
-        if friend_username:
-            self.openChatPage()
-            layout = self.chatPage.friendsListLayout
-
-            # Remove the spacer (last item)
-            spacer_item = layout.takeAt(layout.count() - 1)
+        if friend_username.startswith("#"):
+            # Joins the group, or creates it if nobody has yet
+            self.addFriendPage.addFriendStatusLabel.setText("")
+            self.send({
+                "type": "join_group",
+                "group_name": friend_username
+            })
+        elif friend_username:
+            # Only users the server knows about can be added
+            self.addFriendPage.addFriendStatusLabel.setText("")
+            self.send({
+                "type": "user_exists",
+                "username": friend_username
+            })
+
+    def userExists(self, friend_username: str, exists: bool):
+        if not exists:
+            self.addFriendPage.addFriendStatusLabel.setText(f"User {friend_username} does not exist!")
+            return
+        self.openChatPage()
+        self.runStorage(Database.addConversation, friend_username, callback=lambda _: self.loadConversations())
 
-            # Add the new friend label
-            friend_label = FriendLabel(self, friend_username)
-            layout.addWidget(friend_label)
+    def groupJoined(self, request: str, group_name: str, check: str):
+        if (check == "success"):
+            self.openChatPage()
+            self.runStorage(Database.addConversation, group_name, callback=lambda _: self.loadConversations())
+        elif (request == "join_group"):
+            self.send({
+                "type": "create_group",
+                "group_name": group_name
+            })
+        else:
+            self.addFriendPage.addFriendStatusLabel.setText(f"Could not join group {group_name}!")
+
+    def userSearchRequest(self):
+        prefix: str = self.addFriendPage.addFriendUsernameInput.text().strip()
+        if not prefix or prefix.startswith("#"):
+            self.userSearchModel.setStringList([])
+            return
+        self.send({
+            "type": "user_search",
+            "prefix": prefix
+        })
+
+    def showUserSearch(self, prefix: str, users: list[str]):
+        # Results for text the user has since changed are dropped
+        if prefix != self.addFriendPage.addFriendUsernameInput.text().strip():
+            return
+        self.userSearchModel.setStringList([user for user in users if user != self.username])
+        self.userCompleter.complete()
+
+    def loadConversations(self):
+        self.runStorage(Database.getConversations, callback=self.showConversations)
+
+    def showConversations(self, conversations: list[dict]):
+        layout = self.chatPage.friendsListLayout
+
+        for friend_label in self.friendLabels:
+            layout.removeWidget(friend_label)
+            friend_label.deleteLater()
+        self.friendLabels = []
+
+        # Labels go between the header widgets and the trailing spacer
+        for conversation in conversations:
+            friend_label = FriendLabel(self, conversation)
+            layout.insertWidget(layout.count() - 1, friend_label)
+            self.friendLabels.append(friend_label)
+
+    def searchRequest(self):
+        text: str = self.chatPage.searchLineEdit.text().strip()
+        if not text or not self.username:
+            self.showSearchResults(text, [], [])
+            return
+        self.runStorage(Database.search, text, callback=lambda results: self.showSearchResults(text, results["friends"], results["messages"]))
 
-            # Add the spacer back
-            layout.addItem(spacer_item)
+    def showSearchResults(self, text: str, friends: list[str], messages: list[dict]):
+        # Results for text the user has since changed are dropped
+        if text != self.chatPage.searchLineEdit.text().strip():
+            return
+        results = self.chatPage.searchResultsList
+        results.clear()
+        for friend_username in friends:
+            item = QListWidgetItem(friend_username)
+            item.setData(Qt.UserRole, friend_username)
+            results.addItem(item)
+        for message in messages:
+            item = QListWidgetItem(f"{message['conversation']}: {message['snippet']}")
+            item.setData(Qt.UserRole, message["conversation"])
+            item.setToolTip(message["timestamp"])
+            results.addItem(item)
+        results.setVisible(bool(text))
 
     def refreshChat(self, friend_username: str):
         self.open_chat_username = friend_username
-        messages: list[dict] = self.database.getMessages(self.username, friend_username)
-
-        layout = self.chatPage.messagesContainerLayout
-
-        spacer_item = layout.takeAt(layout.count() - 1)
-        self.clearLayour(layout)
+        self.messagesModel.openConversation(friend_username)
+        self.runStorage(Database.markRead, friend_username, callback=lambda _: self.loadConversations())
+
+    def appendMessages(self):
+        # While the user is reading older history the newest rows are paged in
+        # by messagesScrolled instead
+        if not self.messagesModel.has_newer:
+            self.messagesModel.loadNewer()
+
+    def messagesScrolled(self, value: int):
+        scroll_bar = self.chatPage.messagesView.verticalScrollBar()
+        if value == scroll_bar.minimum():
+            self.messagesModel.loadOlder()
+        elif value == scroll_bar.maximum() and self.messagesModel.has_newer:
+            self.messagesModel.loadNewer()
+
+    def receiveMessages(self):
+        messages: list[dict] = self.clientReceive.takeMessages()
+        if not messages:
+            return
 
-        for mex in messages:
-            if (mex["sender_username"] == self.username):
-                message_widget = MessageWidget(self, "sent", mex["message"])
-            else:
-                message_widget = MessageWidget(self, "received", mex["message"])
-            layout.addWidget(message_widget)
-        layout.addItem(spacer_item)
+        # Acked only once stored, so a message is never acknowledged and lost;
+        # redeliveries are dropped by the server_id unique index
+        self.runStorage(Database.addMessages, messages, callback=lambda _: self.messagesStored(messages))
 
-    def clearLayour(self, layout):
-        while layout.count():
-            child = layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
+    def messagesStored(self, messages: list[dict]):
+        self.send({
+            "type": "ack",
+            "ids": [message["id"] for message in messages]
+        })
+        if any(self.open_chat_username in (message["sender_username"], message["receiver_username"]) for message in messages):
+            self.appendMessages()
+            self.runStorage(Database.markRead, self.open_chat_username)
+        self.loadConversations()
 
     def sendMessage(self, message: str):
-        message_dict: dict = {
-            "type": "message",
-            "sender_username": self.username,
-            "receiver_username": self.open_chat_username,
-            "message": message
-        }
-        self.socket.send(json.dumps(message_dict).encode())
-        self.database.addMessage(self.username, self.open_chat_username, message)
-        self.refreshChat(self.open_chat_username)
+        if self.open_chat_username.startswith("#"):
+            message_dict: dict = {
+                "type": "group_message",
+                "group_name": self.open_chat_username,
+                "message": message
+            }
+        else:
+            message_dict: dict = {
+                "type": "message",
+                "sender_username": self.username,
+                "receiver_username": self.open_chat_username,
+                "message": message
+            }
+        self.send(message_dict)
+        self.runStorage(Database.addMessage, self.username, self.open_chat_username, message,
+                        callback=lambda _: self.messageSent())
+
+    def messageSent(self):
+        self.appendMessages()
+        self.loadConversations()
+
+    def runStorage(self, function: Callable[..., Any], *args, callback: Callable[[Any], None] | None = None) -> Future:
+        # Queues function(database, *args) on the DatabaseWorker; callback gets
+        # the result back on the GUI thread
+        future: Future = self.storage.submit(function, *args)
+        if callback is not None:
+            future.add_done_callback(lambda done: self.signals.storage_done.emit(callback, done))
+        return future
+
+    def storageDone(self, callback: Callable[[Any], None], future: Future):
+        try:
+            result = future.result()
+        except Exception:
+            self.log.exception("storage_failed")
+            return
+        callback(result)
+
+    def closeEvent(self, event):
+        self.closing = True
+        self.storage.stop()
+        super().closeEvent(event)
 
 
 class ClientReceive(Thread):
-    def __init__(self, app: ChatPageApp, socket: socket.socket, database: Database, signals: WorkingSignals):
-        super(ClientReceive, self).__init__()
+    def __init__(self, app: ChatPageApp, socket: socket.socket, signals: WorkingSignals):
+        super(ClientReceive, self).__init__(daemon=True)
         self.app = app
         self.socket = socket
-        self.database = database
         self.signals = signals
         self.running = True
 
+        # Decoded user messages wait here for the GUI thread; one signal is
+        # emitted per burst, however many messages it contains
+        self.messages: Queue[dict] = Queue()
+        self.drain_scheduled = Event()
+        self.log = app.log
+
     def run(self):
+        decoder = FrameDecoder()
         while self.running:
             try:
-                text: str = self.socket.recv(1024).decode()
-                messages: dict = json.loads(text)
-
-                match(messages["type"]):
-                    case "login":
-                        self.signals.user_login.emit(messages["check"])
-
-                    case "register":
-                        self.signals.user_register.emit(messages["check"])
-
-                    case "user_message":
-                        self.database.addMessage(messages["sender_username"], messages["receiver_username"], messages["message"])
-                        if (self.app.open_chat_username == messages["sender_username"]):
-                            self.signals.message_received.emit()
-                        break
-            except Exception as e:
-                print(f"Client Receive Error: {e}")
-                break
+                for messages in decoder.recv(self.socket):
+                    match(messages["type"]):
+                        case "login":
+                            self.signals.user_login.emit(messages["check"], messages.get("token", ""))
+
+                        case "register":
+                            self.signals.user_register.emit(messages["check"], messages.get("token", ""))
+
+                        case "resume":
+                            self.signals.user_resume.emit(messages["check"], messages.get("username", ""), messages.get("token", ""))
+
+                        case "user_message" | "group_message":
+                            self.queueMessages([messages])
+
+                        case "user_messages":
+                            # Offline backlog and retries, sent in pages
+                            self.queueMessages(messages["messages"])
+
+                        case "user_search":
+                            self.signals.user_search.emit(messages["prefix"], messages["users"])
+
+                        case "user_exists":
+                            self.signals.user_exists.emit(messages["username"], messages["exists"])
+
+                        case "create_group" | "join_group":
+                            self.signals.group_joined.emit(messages["type"], messages["group_name"], messages["check"])
+
+            except OSError as e:
+                self.log.info("disconnected", error=str(e))
+                self.running = False
+                self.signals.connection_lost.emit()
+            except Exception:
+                # A malformed frame leaves the stream out of sync, so start a new one
+                self.log.exception("receive_failed")
+                self.running = False
+                self.socket.close()
+                self.signals.connection_lost.emit()
+
+    def queueMessages(self, messages: list[dict]):
+        for message in messages:
+            self.messages.put(message)
+        if not self.drain_scheduled.is_set():
+            self.drain_scheduled.set()
+            self.signals.message_received.emit()
+
+    def takeMessages(self) -> list[dict]:
+        # Called on the GUI thread; cleared first so a message queued while
+        # draining schedules another drain instead of being missed
+        self.drain_scheduled.clear()
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except Empty:
+                return messages
 
 
 if __name__ == "__main__":
+    setupLogging("INFO", LOG_PATH)
     app = QApplication(sys.argv)
     window = ChatPageApp("localhost", 5000)
     window.show()
@@ -1,18 +1,33 @@
-import sqlite3
+from concurrent.futures import Future
+from threading import Thread
+from queue import Queue, Empty
+from typing import Any, Callable, Iterator
 from datetime import datetime
+import sqlite3
+
+from Log import getLogger
+
+log = getLogger(__name__)
 
 
 class Database():
     def __init__(self):
         self.conn: sqlite3.Connection
         self.cursor: sqlite3.Cursor
+        self.username: str = ""
+        # Set by DatabaseWorker, which commits once per batch of jobs instead
+        self.batching = False
 
     def setDatabase(self, username: str):
         self.closeDatabase()
+        self.username = username
         self.conn = sqlite3.connect(f"chatroom-{username}.db", check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self.initDatabase()
 
     def initDatabase(self):
+        # id is the monotonic sequence messages are ordered by; conversation is
+        # the other user, so one conversation is a single range of the index
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -22,42 +37,303 @@ class Database():
                 message TEXT NOT NULL
             )
         ''')
+
+        self.cursor.execute("PRAGMA table_info(messages)")
+        columns: list[str] = [column[1] for column in self.cursor.fetchall()]
+
+        # server_id is the id the server assigned, used to drop redelivered messages
+        if "server_id" not in columns:
+            self.cursor.execute("ALTER TABLE messages ADD COLUMN server_id INTEGER")
+        self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_server_id ON messages(server_id)")
+
+        if "conversation" not in columns:
+            self.cursor.execute("ALTER TABLE messages ADD COLUMN conversation TEXT")
+            self.cursor.execute('''
+                UPDATE messages
+                SET conversation = CASE WHEN sender_username = ? THEN receiver_username ELSE sender_username END
+            ''', (self.username,))
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS messages_conversation ON messages(conversation, id)")
+
+        # One row per conversation with its latest message and unread count, so
+        # the sidebar never has to scan messages
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'conversations'")
+        backfill: bool = self.cursor.fetchone() is None
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                username TEXT PRIMARY KEY,
+                last_message TEXT,
+                last_timestamp DATETIME,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                unread INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS conversations_last_id ON conversations(last_id)")
+        if backfill:
+            self.cursor.execute('''
+                INSERT INTO conversations(username, last_message, last_timestamp, last_id)
+                SELECT messages.conversation, messages.message, messages.timestamp, messages.id
+                FROM messages
+                JOIN (SELECT MAX(id) AS id FROM messages GROUP BY conversation) AS latest ON latest.id = messages.id
+            ''')
+
+        # Full-text index over message bodies, stored as an external-content
+        # table so the text is not duplicated
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+        rebuild: bool = self.cursor.fetchone() is None
+        self.cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(message, content = 'messages', content_rowid = 'id')
+        ''')
+        if rebuild:
+            self.cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts(rowid, message) VALUES (NEW.id, NEW.message);
+            END
+        ''')
+
+        # Kept up to date on every stored message, including batched inserts;
+        # rows skipped by INSERT OR IGNORE do not fire it. Anything that came
+        # from the server (has a server_id) counts as unread, which also covers
+        # group messages. Recreated on every open so older databases get it
+        self.cursor.execute("DROP TRIGGER IF EXISTS messages_conversations")
+        self.cursor.execute('''
+            CREATE TRIGGER messages_conversations AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO conversations(username, last_message, last_timestamp, last_id, unread)
+                VALUES (NEW.conversation, NEW.message, NEW.timestamp, NEW.id, NEW.server_id IS NOT NULL)
+                ON CONFLICT(username) DO UPDATE SET
+                    last_message = excluded.last_message,
+                    last_timestamp = excluded.last_timestamp,
+                    last_id = excluded.last_id,
+                    unread = unread + excluded.unread;
+            END
+        ''')
         self.commit()
 
     def closeDatabase(self):
-        try:
-            self.conn.close()
-        except Exception:
-            pass
+        # sqlite3 rolls back anything uncommitted on close, which inside a
+        # DatabaseWorker batch is every job queued before this one. Those are
+        # committed first, and a failure is raised rather than losing them
+        conn: sqlite3.Connection | None = getattr(self, "conn", None)
+        if conn is None:
+            return
+        conn.commit()
+        conn.close()
+        del self.conn
+
+    def getConversation(self, sender_username: str, receiver_username: str) -> str:
+        # Group messages are addressed to the group, whoever sent them
+        if receiver_username.startswith("#") or sender_username == self.username:
+            return receiver_username
+        return sender_username
 
     def addMessage(self, sender_username: str, receiver_username: str, message: str):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.cursor.execute('''
-            INSERT INTO messages(timestamp, sender_username, receiver_username, message)
-            VALUES (?, ?, ?, ?)
-        ''', (timestamp, sender_username, receiver_username, message))
+            INSERT INTO messages(timestamp, sender_username, receiver_username, message, conversation)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (timestamp, sender_username, receiver_username, message, self.getConversation(sender_username, receiver_username)))
+        self.commit()
+
+    def addMessages(self, messages: list[dict]):
+        # Messages received from the server; ones already stored are ignored
+        self.cursor.executemany('''
+            INSERT OR IGNORE INTO messages(timestamp, sender_username, receiver_username, message, server_id, conversation)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(
+            message["timestamp"],
+            message["sender_username"],
+            message["receiver_username"],
+            message["message"],
+            message["id"],
+            self.getConversation(message["sender_username"], message["receiver_username"])
+        ) for message in messages])
         self.commit()
 
-    def getMessages(self, sender_username: str, receiver_username: str) -> list[dict]:
+    def getMessages(self, conversation: str, after_id: int = 0, limit: int = -1) -> list[dict]:
+        # Everything after after_id, oldest first
+        self.cursor.execute('''
+            SELECT id, timestamp, sender_username, receiver_username, message
+            FROM messages
+            WHERE conversation = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (conversation, after_id, limit))
+        return self.toMessages(self.cursor.fetchall())
+
+    def getMessagesBefore(self, conversation: str, before_id: int | None, limit: int) -> list[dict]:
+        # Latest limit messages before before_id (or the latest overall), oldest first
         self.cursor.execute('''
-            SELECT timestamp, sender_username, receiver_username, message
+            SELECT id, timestamp, sender_username, receiver_username, message
             FROM messages
-            WHERE (sender_username = ? AND receiver_username = ?)
-               OR (sender_username = ? AND receiver_username = ?)
-            ORDER BY timestamp ASC
-        ''', (sender_username, receiver_username, receiver_username, sender_username))
+            WHERE conversation = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (conversation, before_id if before_id is not None else 2 ** 63 - 1, limit))
+        return self.toMessages(reversed(self.cursor.fetchall()))
+
+    def iterMessages(self, conversation: str, after_id: int = 0, page_size: int = 500) -> Iterator[dict]:
+        # Streams a whole conversation a page at a time; uses its own cursor so
+        # other queries can run while it is being consumed
+        cursor = self.conn.cursor()
+        while True:
+            cursor.execute('''
+                SELECT id, timestamp, sender_username, receiver_username, message
+                FROM messages
+                WHERE conversation = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (conversation, after_id, page_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield from self.toMessages(rows)
+            after_id = rows[-1][0]
+
+    def addConversation(self, username: str):
+        # A friend with no messages yet sorts after every active conversation
+        self.cursor.execute("INSERT OR IGNORE INTO conversations(username) VALUES (?)", (username,))
+        self.commit()
+
+    def getConversations(self) -> list[dict]:
+        # Most recent activity first
+        self.cursor.execute('''
+            SELECT username, last_message, last_timestamp, unread
+            FROM conversations
+            ORDER BY last_id DESC
+        ''')
+        conversations = []
+        for row in self.cursor.fetchall():
+            conversations.append({
+                "username": row[0],
+                "last_message": row[1],
+                "last_timestamp": row[2],
+                "unread": row[3]
+            })
+        return conversations
+
+    def markRead(self, username: str):
+        self.cursor.execute("UPDATE conversations SET unread = 0 WHERE username = ? AND unread != 0", (username,))
+        self.commit()
+
+    def search(self, text: str) -> dict:
+        return {
+            "friends": self.searchConversations(text),
+            "messages": self.searchMessages(text)
+        }
+
+    def searchMessages(self, text: str, limit: int = 50) -> list[dict]:
+        # Every word must match as a prefix; best matches first
+        words: list[str] = text.split()
+        if not words:
+            return []
+        query: str = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+        self.cursor.execute('''
+            SELECT messages.id, messages.conversation, messages.timestamp,
+                   snippet(messages_fts, 0, '[', ']', '...', 10)
+            FROM messages_fts
+            JOIN messages ON messages.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ''', (query, limit))
+        results = []
+        for row in self.cursor.fetchall():
+            results.append({
+                "id": row[0],
+                "conversation": row[1],
+                "timestamp": row[2],
+                "snippet": row[3]
+            })
+        return results
+
+    def searchConversations(self, prefix: str, limit: int = 20) -> list[str]:
+        # Range over the primary key instead of LIKE, which cannot use it
+        self.cursor.execute('''
+            SELECT username FROM conversations
+            WHERE username >= ? AND username < ?
+            ORDER BY username
+            LIMIT ?
+        ''', (prefix, prefix + "\U0010ffff", limit))
+        return [row[0] for row in self.cursor.fetchall()]
 
-        rows = self.cursor.fetchall()
+    def toMessages(self, rows) -> list[dict]:
         messages = []
         for row in rows:
             messages.append({
-                "timestamp": row[0],
-                "sender_username": row[1],
-                "receiver_username": row[2],
-                "message": row[3]
+                "id": row[0],
+                "timestamp": row[1],
+                "sender_username": row[2],
+                "receiver_username": row[3],
+                "message": row[4]
             })
 
         return messages
 
     def commit(self):
-        self.conn.commit()
+        if not self.batching:
+            self.conn.commit()
+
+
+class DatabaseWorker(Thread):
+    # Owns the client's sqlite connection so the GUI thread never waits on disk.
+    # Jobs are Database methods run in submission order; everything queued
+    # together is committed once, and the returned futures resolve after that
+    def __init__(self, max_batch_size: int = 200):
+        super(DatabaseWorker, self).__init__(daemon=True)
+        self.database = Database()
+        self.database.batching = True
+        self.max_batch_size = max_batch_size
+        self.jobs: Queue[tuple[Future, Callable, tuple] | None] = Queue()
+        self.running = True
+
+    def submit(self, function: Callable[..., Any], *args) -> Future:
+        # function is called as function(database, *args), e.g. Database.addMessage
+        future: Future = Future()
+        self.jobs.put((future, function, args))
+        return future
+
+    def run(self):
+        while self.running:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except Empty:
+                    break
+            self.runBatch(batch)
+
+    def runBatch(self, batch: list[tuple[Future, Callable, tuple] | None]):
+        results: list[tuple[Future, Any, Exception | None]] = []
+        for job in batch:
+            if job is None:
+                self.running = False
+                continue
+            future, function, args = job
+            try:
+                results.append((future, function(self.database, *args), None))
+            except Exception as e:
+                results.append((future, None, e))
+
+        try:
+            self.database.conn.commit()
+        except AttributeError:
+            # No user logged in yet, so no database is open
+            pass
+        except sqlite3.Error as e:
+            log.exception("commit_failed")
+            # Nothing since the last commit was kept, so no job may report success
+            results = [(future, None, error or e) for future, _, error in results]
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stop(self):
+        # Flushes whatever is still queued before the thread exits
+        self.jobs.put(None)
+        self.join()
@@ -0,0 +1,204 @@
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from typing import Callable
+from queue import Queue, Full
+import logging
+import atexit
+import copy
+import json
+import time
+
+LEVELS: dict[str, int] = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+
+
+class EventLog():
+    # Records are an event name plus fields rather than a sentence, so they can
+    # be grepped, counted and rate limited by event. A bound context function
+    # adds fields that change over the object's life, such as the username
+    def __init__(self, logger: logging.Logger, context: Callable[[], dict] | None = None):
+        self.logger = logger
+        self.context = context
+
+    def bind(self, context: Callable[[], dict]) -> "EventLog":
+        return EventLog(self.logger, context)
+
+    def debug(self, event: str, message: str = "", **fields):
+        self.log(logging.DEBUG, event, message, False, fields)
+
+    def info(self, event: str, message: str = "", **fields):
+        self.log(logging.INFO, event, message, False, fields)
+
+    def warning(self, event: str, message: str = "", **fields):
+        self.log(logging.WARNING, event, message, False, fields)
+
+    def error(self, event: str, message: str = "", **fields):
+        self.log(logging.ERROR, event, message, False, fields)
+
+    def exception(self, event: str, message: str = "", **fields):
+        self.log(logging.ERROR, event, message, True, fields)
+
+    def log(self, level: int, event: str, message: str, exc_info: bool, fields: dict):
+        # Disabled levels return before the context or record are built
+        if not self.logger.isEnabledFor(level):
+            return
+        # detail is what the caller passed, without the bound context
+        detail = fields
+        if self.context is not None:
+            fields = {**self.context(), **fields}
+        self.logger.log(level, message or event, exc_info=exc_info, extra={"event": event, "fields": fields, "detail": detail}, stacklevel=3)
+
+
+def getLogger(name: str) -> EventLog:
+    return EventLog(logging.getLogger(name))
+
+
+class RateLimitFilter(logging.Filter):
+    # Runs on the logging thread before the record is queued, so a storm is
+    # cut down where it starts. Each event may log `burst` records and then
+    # `rate` per second. Warnings and errors from the same event with the
+    # same message, fields and exception are only logged once per
+    # dedupe_window, whichever connection they came from. The next record let
+    # through for an event carries how many were suppressed since the last one
+    def __init__(self, rate: float = 10.0, burst: int = 20, dedupe_window: float = 5.0):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.dedupe_window = dedupe_window
+        self.lock = Lock()
+        self.buckets: dict[tuple[str, str], tuple[float, float]] = {}
+        self.seen: dict[tuple, float] = {}
+        self.suppressed: dict[tuple[str, str], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, getattr(record, "event", record.msg))
+        message = self.dedupeKey(record) if record.levelno >= logging.WARNING else None
+        now = time.monotonic()
+        with self.lock:
+            if message is not None and now - self.seen.get(message, -self.dedupe_window) < self.dedupe_window:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            self.buckets[key] = (tokens - 1, now)
+            if message is not None:
+                self.seen[message] = now
+                if len(self.seen) > 10000:
+                    self.expire(now)
+            suppressed = self.suppressed.pop(key, 0)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def dedupeKey(self, record: logging.LogRecord) -> tuple:
+        # The bound context (connection, user) is left out, so only the
+        # same failure seen from many connections is folded
+        detail: dict = getattr(record, "detail", {})
+        error = record.exc_info[1] if record.exc_info else None
+        return (
+            record.name,
+            getattr(record, "event", record.msg),
+            record.getMessage(),
+            repr(sorted(detail.items())),
+            "" if error is None else f"{type(error).__name__}: {error}"
+        )
+
+    def expire(self, now: float):
+        self.seen = {message: seen for message, seen in self.seen.items() if now - seen < self.dedupe_window}
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Never blocks the caller: when the listener has fallen behind and the
+    # queue is full the record is counted and dropped
+    def __init__(self, queue: Queue):
+        super(DroppingQueueHandler, self).__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock version formats the whole record here; only the arguments
+        # are resolved, the rest is left to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    # One line per record, either "time LEVEL logger event key=value ... message"
+    # or a JSON object
+    def __init__(self, json_lines: bool = False):
+        super(StructuredFormatter, self).__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields: dict = dict(getattr(record, "fields", {}))
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            fields["suppressed"] = suppressed
+        event: str = getattr(record, "event", "")
+        message: str = record.getMessage()
+        if message == event:
+            message = ""
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if self.json_lines:
+            line: dict = {
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "event": event,
+                **{key: value if isinstance(value, (int, float, bool, type(None))) else str(value) for key, value in fields.items()}
+            }
+            if message:
+                line["message"] = message
+            if record.exc_text:
+                line["exception"] = record.exc_text
+            return json.dumps(line)
+
+        parts: list[str] = [self.formatTime(record), record.levelname, record.name]
+        if event:
+            parts.append(event)
+        for key, value in fields.items():
+            value = str(value)
+            if not value or any(character in value for character in ' ="'):
+                value = json.dumps(value)
+            parts.append(f"{key}={value}")
+        if message:
+            parts.append(message)
+        text = " ".join(parts)
+        if record.exc_text:
+            text += "\n" + record.exc_text
+        return text
+
+
+def setupLogging(level: str = "INFO", path: str | None = None, json_lines: bool = False, queue_size: int = 10000, rate: float = 10.0, burst: int = 20) -> DroppingQueueHandler:
+    # Callers only pay for the filter and a queue put; formatting and the
+    # write to stderr or the file happen on the listener's thread
+    target: logging.Handler = logging.FileHandler(path, encoding="utf-8") if path is not None else logging.StreamHandler()
+    target.setFormatter(StructuredFormatter(json_lines))
+
+    handler = DroppingQueueHandler(Queue(queue_size))
+    handler.addFilter(RateLimitFilter(rate, burst))
+    listener = QueueListener(handler.queue, target, respect_handler_level=True)
+    listener.start()
+    # The listener thread is a daemon, so whatever is still queued is written on exit
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LEVELS.get(level.upper(), logging.INFO))
+    return handler
@@ -0,0 +1,60 @@
+import socket
+import struct
+import json
+
+# Every message is a 4-byte big-endian payload length followed by UTF-8 JSON
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode(message: dict) -> bytes:
+    payload: bytes = json.dumps(message).encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder():
+    def __init__(self, chunk_size: int = 65536):
+        self.buffer = bytearray()
+        self.start = 0
+        # recv() reads into this chunk every time instead of allocating new bytes
+        self.chunk = bytearray(chunk_size)
+        self.chunk_view = memoryview(self.chunk)
+
+    def recv(self, sock: socket.socket) -> list[dict]:
+        size: int = sock.recv_into(self.chunk)
+        if size == 0:
+            raise ConnectionResetError("Connection closed by peer")
+        return self.feed(self.chunk_view[:size])
+
+    def feed(self, data: bytes | memoryview) -> list[dict]:
+        self.buffer += data
+        return self.decode()
+
+    def decode(self) -> list[dict]:
+        messages: list[dict] = []
+        buffer = self.buffer
+        start = self.start
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - start >= HEADER.size:
+                (length,) = HEADER.unpack_from(buffer, start)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} bytes limit")
+                end = start + HEADER.size + length
+                if end > len(buffer):
+                    break
+                # Decode straight from the buffer without slicing out a bytes copy
+                messages.append(json.loads(str(view[start + HEADER.size:end], "utf-8")))
+                start = end
+        finally:
+            view.release()
+
+        # Drop consumed bytes only once they make up most of the buffer
+        if start == len(buffer):
+            buffer.clear()
+            start = 0
+        elif start > len(buffer) // 2:
+            del buffer[:start]
+            start = 0
+        self.start = start
+        return messages
@@ -37,6 +37,9 @@ class Ui_ChatPage(object):
         self.searchLineEdit.setToolTip("")
         self.searchLineEdit.setObjectName("searchLineEdit")
         self.friendsListLayout.addWidget(self.searchLineEdit)
+        self.searchResultsList = QtWidgets.QListWidget(self.friendsListWidget)
+        self.searchResultsList.setObjectName("searchResultsList")
+        self.friendsListLayout.addWidget(self.searchResultsList)
         self.line = QtWidgets.QFrame(self.friendsListWidget)
         self.line.setFrameShadow(QtWidgets.QFrame.Plain)
         self.line.setFrameShape(QtWidgets.QFrame.HLine)
@@ -63,18 +66,14 @@ class Ui_ChatPage(object):
         self.sendMessageButton.setObjectName("sendMessageButton")
         self.horizontalLayout.addWidget(self.sendMessageButton)
         self.gridLayout_2.addWidget(self.widget_3, 1, 0, 1, 1)
-        self.messagesArea = QtWidgets.QScrollArea(self.widget_2)
-        self.messagesArea.setWidgetResizable(True)
-        self.messagesArea.setObjectName("messagesArea")
-        self.messagesContainer = QtWidgets.QWidget()
-        self.messagesContainer.setGeometry(QtCore.QRect(0, 0, 474, 407))
-        self.messagesContainer.setObjectName("messagesContainer")
-        self.messagesContainerLayout = QtWidgets.QVBoxLayout(self.messagesContainer)
-        self.messagesContainerLayout.setObjectName("messagesContainerLayout")
-        spacerItem1 = QtWidgets.QSpacerItem(20, 40, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
-        self.messagesContainerLayout.addItem(spacerItem1)
-        self.messagesArea.setWidget(self.messagesContainer)
-        self.gridLayout_2.addWidget(self.messagesArea, 0, 0, 1, 1)
+        self.messagesView = QtWidgets.QListView(self.widget_2)
+        self.messagesView.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.messagesView.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.messagesView.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerItem)
+        self.messagesView.setLayoutMode(QtWidgets.QListView.Batched)
+        self.messagesView.setUniformItemSizes(True)
+        self.messagesView.setObjectName("messagesView")
+        self.gridLayout_2.addWidget(self.messagesView, 0, 0, 1, 1)
         self.gridLayout.addWidget(self.widget_2, 0, 2, 1, 1)
         self.line_2 = QtWidgets.QFrame(self.centralwidget)
         self.line_2.setFrameShadow(QtWidgets.QFrame.Plain)
@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from typing import Callable
+import asyncio
+import socket
+
+from ServerThread import ClientHandler, IncomingMessages
+from Database import DatabasePool, DatabaseWriter
+from Broker import Broker
+from Directory import UserDirectory
+from Passwords import PasswordHasher
+from Tokens import TokenManager
+from Groups import Groups
+from Backpressure import Backpressure
+from Metrics import metrics
+from Log import getLogger
+from Sessions import Sessions
+from Protocol import FrameDecoder
+
+log = getLogger(__name__)
+
+
+class AsyncServer(Thread):
+    def __init__(self, ip: str, port: int, sessions: Sessions, database_pool: DatabasePool, incoming_messages: IncomingMessages, database_writer: DatabaseWriter, broker: Broker, user_directory: UserDirectory, password_hasher: PasswordHasher, token_manager: TokenManager, groups: Groups, backpressure: Backpressure, listen_socket: socket.socket | None = None):
+        super(AsyncServer, self).__init__()
+        self.ip, self.port = ip, port
+        self.listen_socket = listen_socket
+        self.sessions = sessions
+        self.database_pool = database_pool
+        self.incoming_messages = incoming_messages
+        self.database_writer = database_writer
+        self.broker = broker
+        self.user_directory = user_directory
+        self.password_hasher = password_hasher
+        self.token_manager = token_manager
+        self.groups = groups
+        self.backpressure = backpressure
+        # SQLite calls block, so they run on a small fixed pool instead of the event loop
+        self.executor = ThreadPoolExecutor(max_workers=database_pool.size, thread_name_prefix="database")
+        self.loop: asyncio.AbstractEventLoop
+        self.server: asyncio.Server
+        self.connected = False
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+            self.executor.shutdown(wait=False)
+
+    async def serve(self):
+        if self.listen_socket is not None:
+            self.server = await asyncio.start_server(self.acceptConnection, sock=self.listen_socket)
+        else:
+            self.server = await asyncio.start_server(self.acceptConnection, self.ip, self.port, backlog=1024)
+        self.connected = True
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        self.connected = False
+
+        # Let the closed connections finish their cleanup before the loop goes away
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+
+    async def acceptConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = AsyncConnection(self, reader, writer)
+        self.sessions.add(connection)
+        metrics.increment("connections_accepted")
+        await connection.run()
+
+    def stop(self):
+        try:
+            self.loop.call_soon_threadsafe(self.closeConnections)
+        except AttributeError:
+            log.warning("server_not_open", "No Server opened - Closing")
+
+    def closeConnections(self):
+        # Runs on the loop, so clients are closed before serve_forever returns
+        for client in self.sessions.getConnections():
+            client.close()
+        self.server.close()
+
+
+class AsyncConnection(ClientHandler):
+    def __init__(self, server: AsyncServer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ClientHandler.__init__(self, server.sessions, server.database_pool, server.incoming_messages, server.database_writer, server.broker, server.user_directory, server.password_hasher, server.token_manager, server.groups, server.backpressure)
+        self.log = log.bind(self.logContext)
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        # Frames sent from other threads wait here until the loop writes them
+        # all in one go; the transport's own buffer is the rest of the queue
+        self.frames: list[bytes] = []
+        self.frames_bytes = 0
+        self.frames_lock = Lock()
+        self.write_scheduled = False
+        self.drain_task: asyncio.Task | None = None
+
+    async def run(self):
+        peer = self.writer.get_extra_info("peername")
+        self.log.info("client_connected", peer=f"{peer[0]}:{peer[1]}" if peer else "")
+        loop = asyncio.get_running_loop()
+        self.writer.transport.set_write_buffer_limits(self.backpressure.high_water, self.backpressure.low_water)
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data: bytes = await self.reader.read(65536)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    # Awaiting keeps messages from one client in order
+                    await loop.run_in_executor(self.server.executor, self.handleMessage, message)
+
+        except OSError:
+            pass
+        except ValueError as e:
+            self.log.warning("protocol_error", error=str(e))
+        except Exception:
+            self.log.exception("handler_failed")
+
+        self.log.info("client_disconnected")
+        self.sessions.remove(self)
+        self.writer.close()
+
+    def sendData(self, data: bytes):
+        # Called from executor and delivery threads, so hand the write to the loop
+        with self.frames_lock:
+            self.frames.append(data)
+            self.frames_bytes += len(data)
+            schedule: bool = not self.write_scheduled
+            self.write_scheduled = True
+        if schedule:
+            self.server.loop.call_soon_threadsafe(self.writeFrames)
+
+    def writeFrames(self):
+        with self.frames_lock:
+            frames, self.frames = self.frames, []
+            self.frames_bytes = 0
+            self.write_scheduled = False
+        if not self.writer.is_closing():
+            self.writer.writelines(frames)
+
+    def queuedBytes(self) -> int:
+        return self.frames_bytes + self.writer.transport.get_write_buffer_size()
+
+    def watchDrain(self):
+        self.server.loop.call_soon_threadsafe(self.startDrainWatch)
+
+    def startDrainWatch(self):
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = asyncio.ensure_future(self.waitDrained())
+
+    async def waitDrained(self):
+        # drain() only blocks while the transport is over high_water, so poll
+        # for the stretch between the two marks
+        try:
+            while self.queuedBytes() > self.backpressure.low_water:
+                await self.writer.drain()
+                await asyncio.sleep(0.01)
+        except (OSError, RuntimeError):
+            return
+        self.drained()
+
+    def runLater(self, function: Callable, *args):
+        self.server.executor.submit(self.runLogged, function, *args)
+
+    def close(self):
+        self.server.loop.call_soon_threadsafe(self.writer.close)
+
+    def abort(self):
+        # writer.close() would first flush the whole buffer to the slow client
+        self.server.loop.call_soon_threadsafe(self.writer.transport.abort)
@@ -0,0 +1,22 @@
+from typing import Literal
+
+Policy = Literal["drop", "spill", "disconnect"]
+
+
+class Backpressure():
+    # How much chat traffic a client may have waiting to be written before it
+    # counts as a slow consumer, and what happens to it then:
+    #   drop       - the frame is discarded; it is still resent after the
+    #                ack timeout, like any message the client does not ack
+    #   spill      - the frame is not queued and the messages stay in (or go
+    #                to) incoming_messages; once the queue falls to low_water
+    #                the stored backlog is flushed again
+    #   disconnect - the client is closed and picks everything up on reconnect
+    def __init__(self, high_water: int = 1024 * 1024, low_water: int | None = None, policy: Policy = "spill", coalesce_size: int = 256 * 1024):
+        if policy not in ("drop", "spill", "disconnect"):
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        self.policy = policy
+        # Most bytes joined into one write when several frames are waiting
+        self.coalesce_size = coalesce_size
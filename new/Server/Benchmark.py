@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from Protocol import FrameDecoder, encode
+from Server import Server
+from Shards import ShardedServer
+
+
+def runServer(directory: str, port: int, engine: str, hash_iterations: int, shards: int, broker: str, ready, stop):
+    # Child process: the server gets its own interpreter and an empty database
+    os.chdir(directory)
+    if shards > 1:
+        server = ShardedServer("127.0.0.1", port, shards, engine=engine, hash_iterations=hash_iterations, broker=broker)
+    else:
+        server = Server("127.0.0.1", port, engine, hash_iterations=hash_iterations, broker=broker)
+    ready.set()
+    stop.wait()
+    server.closeServer()
+    os._exit(0)
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class ProcessStats():
+    # CPU time and memory of another process and its children (the shards),
+    # read from /proc (Linux only)
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def processTree(self) -> list[int]:
+        pids: list[int] = [self.pid]
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/task/{pid}/children") as file:
+                    pids.extend(int(child) for child in file.read().split())
+            except (OSError, ValueError):
+                pass
+        return pids
+
+    def cpuSeconds(self) -> float | None:
+        total = None
+        for pid in self.processTree():
+            try:
+                with open(f"/proc/{pid}/stat") as file:
+                    # Fields after the command name, which may contain spaces
+                    fields = file.read().rsplit(")", 1)[1].split()
+                total = (total or 0) + (int(fields[11]) + int(fields[12])) / self.ticks
+            except (OSError, IndexError, ValueError):
+                pass
+        return total
+
+    def memory(self) -> dict:
+        # Summed over the processes, so shared pages are counted once per shard
+        memory = {"rss_mb": None, "peak_rss_mb": None}
+        for pid in self.processTree():
+            try:
+                with open(f"/proc/{pid}/status") as file:
+                    for line in file:
+                        if line.startswith("VmRSS:"):
+                            memory["rss_mb"] = round((memory["rss_mb"] or 0) + int(line.split()[1]) / 1024, 1)
+                        elif line.startswith("VmHWM:"):
+                            memory["peak_rss_mb"] = round((memory["peak_rss_mb"] or 0) + int(line.split()[1]) / 1024, 1)
+            except OSError:
+                pass
+        return memory
+
+
+class VirtualClient():
+    def __init__(self, benchmark: "Benchmark", username: str):
+        self.benchmark = benchmark
+        self.username = username
+        self.reader: asyncio.StreamReader
+        self.writer: asyncio.StreamWriter
+        self.replies: asyncio.Queue[dict] = asyncio.Queue()
+        self.reader_task: asyncio.Task | None = None
+        self.received = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.benchmark.port)
+        self.reader_task = asyncio.create_task(self.readFrames())
+
+    async def request(self, message: dict) -> dict:
+        # Retries while the server's password hasher is full
+        while True:
+            self.send(message)
+            reply: dict = await self.replies.get()
+            if reply.get("check") != "busy":
+                return reply
+            await asyncio.sleep(0.05)
+
+    def send(self, message: dict):
+        self.writer.write(encode(message))
+
+    async def readFrames(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data: bytes = await self.reader.read(65536)
+                if not data:
+                    return
+                for message in decoder.feed(data):
+                    match(message["type"]):
+                        case "user_message":
+                            self.receiveMessages([message])
+                        case "user_messages":
+                            self.receiveMessages(message["messages"])
+                        case _:
+                            self.replies.put_nowait(message)
+        except (OSError, asyncio.CancelledError):
+            return
+
+    def receiveMessages(self, messages: list[dict]):
+        now: float = time.perf_counter()
+        for message in messages:
+            self.benchmark.delivered(message, now)
+        self.received += len(messages)
+        # Acked like the real client, otherwise the server keeps resending
+        self.send({
+            "type": "ack",
+            "ids": [message["id"] for message in messages]
+        })
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class Benchmark():
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.port: int = args.port or self.freePort()
+        self.usernames: list[str] = [f"bench{index}" for index in range(args.clients)]
+        offline_count: int = int(args.clients * args.offline)
+        self.offline: list[str] = self.usernames[:offline_count]
+        self.online: list[str] = self.usernames[offline_count:]
+        self.padding: str = "x" * max(0, args.size - 32)
+
+        self.sent: dict[str, float] = {}
+        self.latencies: list[float] = []
+        self.backlog_received = 0
+        self.first_send = 0.0
+        self.last_delivery = 0.0
+        self.all_online_delivered = asyncio.Event()
+        self.expected_online = 0
+
+    def freePort(self) -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def delivered(self, message: dict, now: float):
+        key: str = message["message"].split(" ", 1)[0]
+        sent_at = self.sent.pop(key, None)
+        if sent_at is None:
+            # Redelivery of a message already counted
+            return
+        if message["receiver_username"] in self.offline_set:
+            self.backlog_received += 1
+            return
+        self.latencies.append(now - sent_at)
+        self.last_delivery = now
+        if len(self.latencies) >= self.expected_online:
+            self.all_online_delivered.set()
+
+    async def run(self) -> dict:
+        self.offline_set = set(self.offline)
+        limit = asyncio.Semaphore(self.args.concurrency)
+
+        async def register(username: str):
+            async with limit:
+                client = VirtualClient(self, username)
+                await client.connect()
+                reply = await client.request({"type": "register", "username": username, "password": "benchmark"})
+                if reply.get("check") != "success":
+                    raise RuntimeError(f"Register failed for {username}: {reply}")
+                await client.close()
+
+        async def login(username: str) -> VirtualClient:
+            async with limit:
+                client = VirtualClient(self, username)
+                await client.connect()
+                reply = await client.request({"type": "login", "username": username, "password": "benchmark"})
+                if reply.get("check") != "success":
+                    raise RuntimeError(f"Login failed for {username}: {reply}")
+                return client
+
+        started: float = time.perf_counter()
+        await asyncio.gather(*(register(username) for username in self.usernames))
+        register_seconds: float = time.perf_counter() - started
+
+        started = time.perf_counter()
+        clients: list[VirtualClient] = await asyncio.gather(*(login(username) for username in self.online))
+        login_seconds: float = time.perf_counter() - started
+
+        # Every online client sends its messages to random receivers; a
+        # receiver is offline with the configured probability
+        rng = random.Random(self.args.seed)
+        plan: list[tuple[VirtualClient, str]] = []
+        for client in clients:
+            for _ in range(self.args.messages):
+                pool = self.offline if self.offline and rng.random() < self.args.offline else self.online
+                receiver: str = rng.choice(pool)
+                if receiver == client.username and len(pool) > 1:
+                    receiver = pool[(pool.index(receiver) + 1) % len(pool)]
+                plan.append((client, receiver))
+        rng.shuffle(plan)
+        self.expected_online = sum(1 for _, receiver in plan if receiver not in self.offline_set)
+        if self.expected_online == 0:
+            self.all_online_delivered.set()
+
+        cpu_before = self.stats.cpuSeconds()
+        self.first_send = time.perf_counter()
+        interval: float = 1 / self.args.rate if self.args.rate else 0
+        for index, (client, receiver) in enumerate(plan):
+            key = str(index)
+            self.sent[key] = time.perf_counter()
+            client.send({
+                "type": "message",
+                "sender_username": client.username,
+                "receiver_username": receiver,
+                "message": f"{key} {self.padding}"
+            })
+            if interval:
+                await asyncio.sleep(max(0, self.first_send + (index + 1) * interval - time.perf_counter()))
+            elif index % 200 == 0:
+                # Let the readers run so receive latency is not inflated by the send loop
+                await asyncio.sleep(0)
+        send_seconds: float = time.perf_counter() - self.first_send
+
+        try:
+            await asyncio.wait_for(self.all_online_delivered.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out with {self.expected_online - len(self.latencies)} online messages undelivered")
+        cpu_after = self.stats.cpuSeconds()
+        live_seconds: float = max(self.last_delivery, self.first_send) - self.first_send
+
+        # Offline receivers log in and drain what was stored for them
+        expected_backlog: int = len(plan) - self.expected_online
+        started = time.perf_counter()
+        late_clients: list[VirtualClient] = await asyncio.gather(*(login(username) for username in self.offline))
+        while self.backlog_received < expected_backlog and time.perf_counter() - started < self.args.timeout:
+            await asyncio.sleep(0.01)
+        backlog_seconds: float = time.perf_counter() - started
+
+        memory: dict = self.stats.memory()
+        for client in clients + late_clients:
+            await client.close()
+
+        latencies: list[float] = sorted(self.latencies)
+        cpu_seconds = None if cpu_before is None or cpu_after is None else round(cpu_after - cpu_before, 3)
+        return {
+            "config": {
+                "engine": self.args.engine,
+                "shards": self.args.shards,
+                "broker": self.args.broker,
+                "clients": self.args.clients,
+                "messages_per_client": self.args.messages,
+                "offline_fraction": self.args.offline,
+                "message_size": self.args.size,
+                "rate": self.args.rate,
+                "hash_iterations": self.args.hash_iterations,
+                "seed": self.args.seed
+            },
+            "setup": {
+                "register_seconds": round(register_seconds, 3),
+                "login_seconds": round(login_seconds, 3)
+            },
+            "live": {
+                "sent": len(plan),
+                "online_expected": self.expected_online,
+                "online_delivered": len(latencies),
+                "send_seconds": round(send_seconds, 3),
+                "seconds": round(live_seconds, 3),
+                "throughput_per_second": round(len(latencies) / live_seconds, 1) if live_seconds else None,
+                "latency_ms": {
+                    "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                    "p50": self.milliseconds(percentile(latencies, 0.50)),
+                    "p99": self.milliseconds(percentile(latencies, 0.99)),
+                    "p999": self.milliseconds(percentile(latencies, 0.999)),
+                    "max": self.milliseconds(latencies[-1] if latencies else None)
+                }
+            },
+            "backlog": {
+                "expected": expected_backlog,
+                "delivered": self.backlog_received,
+                "seconds": round(backlog_seconds, 3),
+                "throughput_per_second": round(self.backlog_received / backlog_seconds, 1) if backlog_seconds else None
+            },
+            "server": {
+                "cpu_seconds": cpu_seconds,
+                "cpu_percent": round(cpu_seconds / live_seconds * 100, 1) if cpu_seconds is not None and live_seconds else None,
+                **memory
+            }
+        }
+
+    def milliseconds(self, seconds: float | None) -> float | None:
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    def start(self) -> dict:
+        directory: str = tempfile.mkdtemp(prefix="chatroom-benchmark-")
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(target=runServer, args=(directory, self.port, self.args.engine, self.args.hash_iterations, self.args.shards, self.args.broker, ready, stop))
+        process.start()
+        try:
+            if not ready.wait(30):
+                raise RuntimeError("Server did not start")
+            self.waitForPort()
+            self.stats = ProcessStats(process.pid)
+            return asyncio.run(self.run())
+        finally:
+            stop.set()
+            process.join(30)
+            if process.is_alive():
+                process.kill()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def waitForPort(self):
+        deadline: float = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError(f"Server is not listening on port {self.port}")
+
+
+def parseArguments(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the chat server with virtual clients")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread")
+    parser.add_argument("--shards", type=int, default=1, help="server processes sharing the port")
+    parser.add_argument("--broker", choices=("sqlite", "memory", "log"), default="sqlite", help="where messages wait for their receiver; only sqlite can be sharded")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=100, help="messages sent by each online client")
+    parser.add_argument("--offline", type=float, default=0.2, help="fraction of clients, and of messages, that are offline")
+    parser.add_argument("--size", type=int, default=100, help="approximate message size in bytes")
+    parser.add_argument("--rate", type=float, default=0, help="total messages per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=32, help="registrations and logins in flight at once")
+    parser.add_argument("--hash-iterations", type=int, default=1000, help="PBKDF2 iterations; the server default makes setup dominate")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    results = Benchmark(args).start()
+    # Sorted keys and fixed rounding so two runs diff cleanly
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4, sort_keys=True)
+    print(json.dumps(results, indent=4, sort_keys=True))
@@ -0,0 +1,219 @@
+from threading import Lock
+from typing import Iterator
+from datetime import datetime
+import heapq
+import time
+
+from Database import DatabasePool, DatabaseWriter
+
+# Ids reserved per durable write of the ceiling
+ID_BLOCK = 100000
+
+
+def clientId(message: dict) -> int:
+    # The id the receiver is sent and acks; a stored group copy can have its
+    # own id and keep the group message's as origin_id
+    return message.get("origin_id") or message["id"]
+
+
+class Broker():
+    # Holds each receiver's messages until they ack them. IncomingMessages
+    # pushes new messages to whoever is online; the broker keeps them for
+    # everyone else, and a login reads its backlog back through subscribe.
+    #
+    # Ids are handed out here, before a message is stored, and must never be
+    # reused: clients drop any id they have already seen. Backends persist a
+    # ceiling every ID_BLOCK ids and start above it after a restart
+    def __init__(self, id_offset: int = 0, id_stride: int = 1):
+        self.id_lock = Lock()
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.next_id = 1
+        self.id_ceiling = 0
+
+    def startIds(self, floor: int):
+        # First id above floor that belongs to this offset
+        self.next_id = floor + 1 + (self.id_offset - floor - 1) % self.id_stride
+        self.id_ceiling = floor
+
+    def allocateIds(self, count: int) -> int:
+        # First of `count` ids, id_stride apart
+        with self.id_lock:
+            first_id = self.next_id
+            self.next_id += count * self.id_stride
+            if self.next_id > self.id_ceiling:
+                self.id_ceiling = self.next_id + ID_BLOCK * self.id_stride
+                self.reserveIds(self.id_ceiling)
+        return first_id
+
+    def reserveIds(self, ceiling: int):
+        # Must not return before the ceiling would survive a restart
+        pass
+
+    def addMessage(self, sender_username: str, receiver_username: str, message: str) -> dict:
+        stored: dict = {
+            "id": self.allocateIds(1),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "sender_username": sender_username,
+            "receiver_username": receiver_username,
+            "message": message,
+            "group_name": None,
+            "origin_id": None
+        }
+        self.publish([stored])
+        return stored
+
+    def addGroupMessage(self, sender_username: str, group_name: str, message: str) -> dict:
+        # The copy sent to online members; it is not stored, but its id still
+        # comes from the same sequence so clients can dedupe on it
+        return {
+            "id": self.allocateIds(1),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "sender_username": sender_username,
+            "receiver_username": group_name,
+            "message": message,
+            "group_name": group_name,
+            "origin_id": None
+        }
+
+    def storeGroupMessage(self, message: dict, receivers: list[str]) -> list[dict]:
+        # One copy per member, published together. Each copy needs an id of its
+        # own here, but clients are sent the group message's, which members
+        # online at the time may have seen already
+        first_id: int = self.allocateIds(len(receivers))
+        stored: list[dict] = [{
+            **message,
+            "id": first_id + index * self.id_stride,
+            "receiver_username": receiver_username,
+            "origin_id": message["id"]
+        } for index, receiver_username in enumerate(receivers)]
+        self.publish(stored)
+        return stored
+
+    def subscribe(self, username: str, page_size: int) -> Iterator[list[dict]]:
+        # The user's stored messages, oldest first, a page at a time
+        self.sync()
+        after_id = 0
+        while True:
+            messages: list[dict] = self.pending(username, after_id, page_size)
+            if not messages:
+                return
+            yield messages
+            after_id = messages[-1]["id"]
+
+    def start(self):
+        pass
+
+    def publish(self, messages: list[dict]):
+        raise NotImplementedError
+
+    def pending(self, username: str, after_id: int, limit: int) -> list[dict]:
+        raise NotImplementedError
+
+    def ack(self, message_ids: list[int], username: str):
+        # Takes the ids clients were sent, see clientId. Only the receiver can
+        # acknowledge, so ids from other users are ignored
+        raise NotImplementedError
+
+    def sync(self):
+        # Returns once everything published so far is visible to pending
+        pass
+
+    def backlog(self) -> int:
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class SQLiteBroker(Broker):
+    # The reference backend: rows in incoming_messages, written in batches by
+    # the DatabaseWriter and read back through the reader pool. The only one
+    # several shards can share
+    def __init__(self, database_writer: DatabaseWriter, database_pool: DatabasePool, id_offset: int = 0, id_stride: int = 1):
+        super(SQLiteBroker, self).__init__(id_offset, id_stride)
+        self.database_writer = database_writer
+        self.database_pool = database_pool
+        with database_pool.reader() as database:
+            floor: int = database.getMessageIdFloor()
+            # Rows this shard's writer owns; the writer tracks changes from here
+            self.initial_backlog: int = database.countMessages(id_offset, id_stride)
+        self.startIds(floor)
+
+    def reserveIds(self, ceiling: int):
+        # The counter is only ever raised, so shards cannot lower each other's ceiling
+        self.database_writer.call(self.database_writer.database.reserveMessageIds, ceiling)
+
+    def publish(self, messages: list[dict]):
+        self.database_writer.storeMessages(messages)
+
+    def pending(self, username: str, after_id: int, limit: int) -> list[dict]:
+        with self.database_pool.reader() as database:
+            return database.getUserMessages(username, after_id, limit)
+
+    def ack(self, message_ids: list[int], username: str):
+        self.database_writer.removeMessages(message_ids, username)
+
+    def sync(self):
+        self.database_writer.sync()
+
+    def backlog(self) -> int:
+        return self.initial_backlog + self.database_writer.backlog
+
+
+class MemoryBroker(Broker):
+    # A dict of messages per receiver. Fastest, but nothing survives a
+    # restart and every process has its own, so it cannot be used by shards
+    def __init__(self):
+        super(MemoryBroker, self).__init__()
+        self.lock = Lock()
+        self.queues: dict[str, dict[int, dict]] = {}
+        self.stored = 0
+        # Nothing is kept to start above, so ids start from the clock in
+        # microseconds, which is ahead of any id a client saw before a restart
+        self.startIds(time.time_ns() // 1000)
+
+    def publish(self, messages: list[dict]):
+        with self.lock:
+            self.store(messages)
+
+    def store(self, messages: list[dict]):
+        # Caller must hold the lock
+        for message in messages:
+            queue = self.queues.setdefault(message["receiver_username"], {})
+            if message["id"] not in queue:
+                queue[message["id"]] = message
+                self.stored += 1
+
+    def storeGroupMessage(self, message: dict, receivers: list[str]) -> list[dict]:
+        # Queues are per receiver, so every copy keeps the group message's id
+        stored: list[dict] = [{**message, "receiver_username": receiver_username} for receiver_username in receivers]
+        self.publish(stored)
+        return stored
+
+    def pending(self, username: str, after_id: int, limit: int) -> list[dict]:
+        # Publishers can finish out of id order, so the page is picked by id
+        with self.lock:
+            queue = self.queues.get(username)
+            if not queue:
+                return []
+            message_ids: list[int] = heapq.nsmallest(limit, (message_id for message_id in queue if message_id > after_id))
+            return [queue[message_id] for message_id in message_ids]
+
+    def ack(self, message_ids: list[int], username: str):
+        with self.lock:
+            self.remove(message_ids, username)
+
+    def remove(self, message_ids: list[int], username: str) -> list[int]:
+        # Caller must hold the lock; returns the ids that were stored
+        queue = self.queues.get(username)
+        if not queue:
+            return []
+        removed: list[int] = [message_id for message_id in message_ids if queue.pop(message_id, None) is not None]
+        if not queue:
+            del self.queues[username]
+        self.stored -= len(removed)
+        return removed
+
+    def backlog(self) -> int:
+        return self.stored
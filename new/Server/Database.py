@@ -1,12 +1,38 @@
-import sqlite3
+from threading import Thread, Event, Lock
+from concurrent.futures import Future
+from contextlib import contextmanager
+from queue import Queue, Empty
+from typing import Any, Callable, Iterator
 from datetime import datetime
+import sqlite3
+import time
+
+from Metrics import metrics
+from Log import getLogger
+
+log = getLogger(__name__)
+
+
+DATABASE_PATH = "chatroom.db"
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456"
+)
 
 
 class Database():
-    def __init__(self):
-        self.conn = sqlite3.connect("chatroom.db", check_same_thread=False)
+    def __init__(self, path: str = DATABASE_PATH):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
 
+    def initDatabase(self):
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 username TEXT PRIMARY KEY,
@@ -24,13 +50,69 @@ class Database():
             )
         ''')
 
+        # Set on each member's copy of a group message stored while they were offline
+        self.cursor.execute("PRAGMA table_info(incoming_messages)")
+        columns: list[str] = [column[1] for column in self.cursor.fetchall()]
+        if "group_name" not in columns:
+            self.cursor.execute("ALTER TABLE incoming_messages ADD COLUMN group_name TEXT")
+        # The group message's id on those copies, which is the one clients are sent and ack
+        if "origin_id" not in columns:
+            self.cursor.execute("ALTER TABLE incoming_messages ADD COLUMN origin_id INTEGER")
+
+        # Turns "pending messages for user X" into an index range scan
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS incoming_messages_receiver
+            ON incoming_messages(receiver_username, id)
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS incoming_messages_origin
+            ON incoming_messages(receiver_username, origin_id) WHERE origin_id IS NOT NULL
+        ''')
+
+        # Group names start with "#" so they never collide with usernames
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS groups (
+                group_name TEXT PRIMARY KEY,
+                owner_username TEXT NOT NULL,
+                created DATETIME NOT NULL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_members (
+                group_name TEXT NOT NULL,
+                username TEXT NOT NULL,
+                PRIMARY KEY (group_name, username)
+            ) WITHOUT ROWID
+        ''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS group_members_username ON group_members(username)")
+
+        # Session token signing key and revocations, loaded once by TokenManager
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS revoked_tokens (
+                token_id TEXT PRIMARY KEY,
+                expires INTEGER NOT NULL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS revoked_users (
+                username TEXT PRIMARY KEY,
+                revoked_at INTEGER NOT NULL
+            )
+        ''')
+
         self.commit()
 
-    def loginUser(self, username: str, password: str) -> bool:
-        self.cursor.execute("SELECT username FROM users WHERE username = ? AND password = ?", (username, password))
-        if self.cursor.fetchone():
-            return True
-        return False
+    def getPassword(self, username: str) -> str | None:
+        # The stored hash (or a plaintext password from before hashing), checked by PasswordHasher
+        self.cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
 
     def registerUser(self, username: str, password: str) -> bool:
         self.cursor.execute("SELECT username FROM users WHERE username = ?", (username,))
@@ -44,16 +126,91 @@ class Database():
         self.commit()
         return True
 
-    def addMessage(self, sender_username: str, receiver_username: str, message: str):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def searchUsers(self, prefix: str, limit: int) -> list[str]:
+        # Range over the primary key index; LIKE 'prefix%' would scan the table
+        self.cursor.execute('''
+            SELECT username FROM users
+            WHERE username >= ? AND username < ?
+            ORDER BY username
+            LIMIT ?
+        ''', (prefix, prefix + "\U0010ffff", limit))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def userExists(self, username: str) -> bool:
+        self.cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
+        return self.cursor.fetchone() is not None
+
+    def getSetting(self, key: str) -> str | None:
+        self.cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def setSetting(self, key: str, value: str):
+        self.cursor.execute("INSERT OR REPLACE INTO settings(key, value) VALUES (?, ?)", (key, value))
+        self.commit()
+
+    def getRevokedTokens(self, now: int) -> dict[str, int]:
+        # Expired tokens are rejected anyway, so their revocations are dropped
+        self.cursor.execute("DELETE FROM revoked_tokens WHERE expires <= ?", (now,))
+        self.commit()
+        self.cursor.execute("SELECT token_id, expires FROM revoked_tokens")
+        return dict(self.cursor.fetchall())
+
+    def getRevokedUsers(self) -> dict[str, int]:
+        self.cursor.execute("SELECT username, revoked_at FROM revoked_users")
+        return dict(self.cursor.fetchall())
+
+    def revokeToken(self, token_id: str, expires: int):
+        self.cursor.execute("INSERT OR REPLACE INTO revoked_tokens(token_id, expires) VALUES (?, ?)", (token_id, expires))
+        self.commit()
+
+    def revokeUser(self, username: str, revoked_at: int):
+        self.cursor.execute("INSERT OR REPLACE INTO revoked_users(username, revoked_at) VALUES (?, ?)", (username, revoked_at))
+        self.commit()
+
+    def createGroup(self, group_name: str, owner_username: str) -> bool:
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO groups(group_name, owner_username, created) VALUES (?, ?, ?)
+        ''', (group_name, owner_username, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        if self.cursor.rowcount == 0:
+            return False
+        self.cursor.execute("INSERT INTO group_members(group_name, username) VALUES (?, ?)", (group_name, owner_username))
+        self.commit()
+        return True
+
+    def addGroupMember(self, group_name: str, username: str) -> bool:
         self.cursor.execute('''
-            INSERT INTO incoming_messages(timestamp, sender_username, receiver_username, message)
-            VALUES (?, ?, ?, ?)
-        ''', (timestamp, sender_username, receiver_username, message))
+            INSERT OR IGNORE INTO group_members(group_name, username)
+            SELECT group_name, ? FROM groups WHERE group_name = ?
+        ''', (username, group_name))
         self.commit()
+        return self.userInGroup(group_name, username)
+
+    def removeGroupMember(self, group_name: str, username: str):
+        self.cursor.execute("DELETE FROM group_members WHERE group_name = ? AND username = ?", (group_name, username))
+        self.commit()
+
+    def userInGroup(self, group_name: str, username: str) -> bool:
+        self.cursor.execute("SELECT 1 FROM group_members WHERE group_name = ? AND username = ?", (group_name, username))
+        return self.cursor.fetchone() is not None
 
-    def getMessages(self) -> list[dict]:
-        self.cursor.execute("SELECT id, timestamp, sender_username, receiver_username, message FROM incoming_messages")
+    def getGroupMembers(self, group_name: str) -> list[str] | None:
+        # None when the group does not exist
+        self.cursor.execute("SELECT 1 FROM groups WHERE group_name = ?", (group_name,))
+        if self.cursor.fetchone() is None:
+            return None
+        self.cursor.execute("SELECT username FROM group_members WHERE group_name = ?", (group_name,))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def getUserMessages(self, receiver_username: str, after_id: int = 0, limit: int = -1) -> list[dict]:
+        # Keyset pagination: pass the last id of the previous page as after_id
+        self.cursor.execute('''
+            SELECT id, timestamp, sender_username, receiver_username, message, group_name, origin_id
+            FROM incoming_messages
+            WHERE receiver_username = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (receiver_username, after_id, limit))
         rows = self.cursor.fetchall()
         messages = []
         for row in rows:
@@ -62,16 +219,207 @@ class Database():
                 "timestamp": row[1],
                 "sender_username": row[2],
                 "receiver_username": row[3],
-                "message": row[4]
+                "message": row[4],
+                "group_name": row[5],
+                "origin_id": row[6]
             })
         return messages
 
-    def removeMessage(self, message_id: int):
-        self.cursor.execute("DELETE FROM incoming_messages WHERE id = ?", (message_id,))
+    def getMessageIdFloor(self) -> int:
+        # Highest id handed out so far: rows still waiting, and the AUTOINCREMENT
+        # counter, which remembers deleted rows and the blocks reserved below
+        self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM incoming_messages")
+        floor: int = self.cursor.fetchone()[0]
+        self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'incoming_messages'")
+        row = self.cursor.fetchone()
+        if row is not None:
+            floor = max(floor, row[0])
+        return floor
+
+    def reserveMessageIds(self, ceiling: int):
+        # Raises the AUTOINCREMENT counter, which is never lowered, so ids up to
+        # ceiling are not handed out again after a restart
+        self.cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'incoming_messages'", (ceiling,))
+        if self.cursor.rowcount == 0:
+            self.cursor.execute("INSERT INTO sqlite_sequence(name, seq) VALUES ('incoming_messages', ?)", (ceiling,))
         self.commit()
 
+    def countMessages(self, id_offset: int = 0, id_stride: int = 1) -> int:
+        self.cursor.execute("SELECT COUNT(*) FROM incoming_messages WHERE id % ? = ?", (id_stride, id_offset))
+        return self.cursor.fetchone()[0]
+
     def commit(self):
         self.conn.commit()
 
     def close(self):
         self.conn.close()
+
+
+class DatabasePool():
+    # Bounded set of read connections shared by every client; WAL lets them
+    # read while the DatabaseWriter commits
+    def __init__(self, size: int = 4):
+        self.size = size
+        self.created = 0
+        self.lock = Lock()
+        self.readers: Queue[Database] = Queue()
+
+    @contextmanager
+    def reader(self) -> Iterator[Database]:
+        database = self.acquire()
+        try:
+            yield database
+        finally:
+            self.readers.put(database)
+
+    def acquire(self) -> Database:
+        with self.lock:
+            if self.readers.empty() and self.created < self.size:
+                self.created += 1
+                return Database()
+        return self.readers.get()
+
+    def close(self):
+        while not self.readers.empty():
+            self.readers.get().close()
+
+
+class DatabaseWriter(Thread):
+    # Single writer for incoming_messages: inserts and deletes from every
+    # connection are queued and committed together in one transaction
+    def __init__(self, max_batch_size: int = 500, max_delay: float = 0.05):
+        super(DatabaseWriter, self).__init__()
+        self.database = Database()
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.operations: Queue[tuple[str, Any]] = Queue()
+        self.running = True
+        self.blocking_operations = ("sync", "call", "stop")
+        # Net rows this writer added to incoming_messages since startup
+        self.backlog = 0
+        self.batch_timer = metrics.timer("db.write_batch", every=1)
+
+    def storeMessages(self, messages: list[dict]):
+        # Ids come from the SQLiteBroker, so callers have them before the rows are committed
+        self.operations.put(("insert", messages))
+
+    def removeMessages(self, message_ids: list[int], receiver_username: str):
+        # Only the receiver can acknowledge, so ids from other users are ignored
+        self.operations.put(("delete", (message_ids, receiver_username)))
+
+    def registerUser(self, username: str, password: str) -> bool:
+        return self.call(self.database.registerUser, username, password)
+
+    def createGroup(self, group_name: str, owner_username: str) -> bool:
+        return self.call(self.database.createGroup, group_name, owner_username)
+
+    def addGroupMember(self, group_name: str, username: str) -> bool:
+        return self.call(self.database.addGroupMember, group_name, username)
+
+    def removeGroupMember(self, group_name: str, username: str):
+        self.call(self.database.removeGroupMember, group_name, username)
+
+    def updatePassword(self, username: str, password: str):
+        self.operations.put(("password", (password, username)))
+
+    def revokeToken(self, token_id: str, expires: int):
+        self.call(self.database.revokeToken, token_id, expires)
+
+    def revokeUser(self, username: str, revoked_at: int):
+        self.call(self.database.revokeUser, username, revoked_at)
+
+    def call(self, function: Callable, *args) -> Any:
+        # Runs function on the writer thread, inside the current batch, and waits for it
+        future: Future = Future()
+        self.operations.put(("call", (future, function, args)))
+        return future.result()
+
+    def sync(self):
+        # Blocks until everything queued so far is committed
+        done = Event()
+        self.operations.put(("sync", done))
+        done.wait()
+
+    def run(self):
+        while self.running:
+            batch: list[tuple[str, Any]] = [self.operations.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size and batch[-1][0] not in self.blocking_operations:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.operations.get(timeout=timeout))
+                except Empty:
+                    break
+            self.writeBatch(batch)
+        self.database.close()
+
+    def writeBatch(self, batch: list[tuple[str, Any]]):
+        # Keyed by the id clients ack, which is origin_id on stored group copies
+        inserts: dict[tuple[int, str], dict] = {}
+        deletes: list[tuple[str, int]] = []
+        waiters: list[Event] = []
+        calls: list[tuple[Future, Callable, tuple]] = []
+        passwords: list[tuple[str, str]] = []
+        for operation, payload in batch:
+            match(operation):
+                case "insert":
+                    for message in payload:
+                        inserts[(message["origin_id"] or message["id"], message["receiver_username"])] = message
+                case "delete":
+                    # A message delivered before its insert was flushed never hits the disk
+                    message_ids, receiver_username = payload
+                    for message_id in message_ids:
+                        if inserts.pop((message_id, receiver_username), None) is None:
+                            deletes.append((receiver_username, message_id))
+                case "password":
+                    passwords.append(payload)
+                case "sync":
+                    waiters.append(payload)
+                case "call":
+                    calls.append(payload)
+                case "stop":
+                    self.running = False
+
+        try:
+            with self.batch_timer():
+                self.writeOperations(inserts, deletes, passwords, calls)
+        except sqlite3.Error:
+            log.exception("write_batch_failed", operations=len(batch))
+            self.database.conn.rollback()
+
+        for waiter in waiters:
+            waiter.set()
+        for future, function, args in calls:
+            if not future.done():
+                future.set_exception(RuntimeError("Database write failed"))
+
+    def writeOperations(self, inserts: dict[tuple[int, str], dict], deletes: list[tuple[str, int]], passwords: list[tuple[str, str]], calls: list[tuple[Future, Callable, tuple]]):
+        backlog = 0
+        if inserts:
+            self.database.cursor.executemany('''
+                INSERT INTO incoming_messages(id, timestamp, sender_username, receiver_username, message, group_name, origin_id)
+                VALUES (:id, :timestamp, :sender_username, :receiver_username, :message, :group_name, :origin_id)
+            ''', inserts.values())
+            backlog += len(inserts)
+        if deletes:
+            # Separate statements so each is a lookup on one of the two indexes
+            self.database.cursor.executemany("DELETE FROM incoming_messages WHERE receiver_username = ? AND id = ?", deletes)
+            backlog -= self.database.cursor.rowcount
+            self.database.cursor.executemany("DELETE FROM incoming_messages WHERE receiver_username = ? AND origin_id = ?", deletes)
+            backlog -= self.database.cursor.rowcount
+        if passwords:
+            self.database.cursor.executemany("UPDATE users SET password = ? WHERE username = ?", passwords)
+        for future, function, args in calls:
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.database.commit()
+        self.backlog += backlog
+
+    def stop(self):
+        # Flushes whatever is still queued before the thread exits
+        self.operations.put(("stop", None))
+        self.join()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable
+
+from Database import DatabasePool
+
+
+class UserDirectory():
+    # Prefix search over registered users for autocomplete. Results are cached
+    # per prefix, least recently used first out, so typing the same prefixes
+    # again never reaches the database
+    def __init__(self, database_pool: DatabasePool, limit: int = 20, max_entries: int = 4096):
+        self.database_pool = database_pool
+        self.limit = limit
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.searches: OrderedDict[str, list[str]] = OrderedDict()
+        self.users: OrderedDict[str, bool] = OrderedDict()
+        # Bumped on every registration so a lookup that raced with one is not cached
+        self.generation = 0
+        # Called with the username after each registration, for other shards
+        self.changed: Callable[[str], None] | None = None
+
+    def search(self, prefix: str, limit: int | None = None) -> list[str]:
+        limit = self.limit if limit is None else max(0, min(limit, self.limit))
+        with self.lock:
+            usernames = self.searches.get(prefix)
+            if usernames is not None:
+                self.searches.move_to_end(prefix)
+                return usernames[:limit]
+            generation = self.generation
+
+        # Always fetch the full limit so smaller requests can share the entry
+        with self.database_pool.reader() as database:
+            usernames = database.searchUsers(prefix, self.limit)
+        with self.lock:
+            if generation == self.generation:
+                self.cache(self.searches, prefix, usernames)
+        return usernames[:limit]
+
+    def exists(self, username: str) -> bool:
+        with self.lock:
+            exists = self.users.get(username)
+            if exists is not None:
+                self.users.move_to_end(username)
+                return exists
+            generation = self.generation
+
+        with self.database_pool.reader() as database:
+            exists = database.userExists(username)
+        with self.lock:
+            if generation == self.generation:
+                self.cache(self.users, username, exists)
+        return exists
+
+    def addUser(self, username: str):
+        self.userAdded(username)
+        if self.changed is not None:
+            self.changed(username)
+
+    def userAdded(self, username: str):
+        # Only the prefixes of the new name can have changed
+        with self.lock:
+            self.generation += 1
+            for end in range(len(username) + 1):
+                self.searches.pop(username[:end], None)
+            self.users[username] = True
+            self.users.move_to_end(username)
+
+    def cache(self, entries: OrderedDict, key: str, value: Any):
+        # Caller must hold the lock
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
@@ -0,0 +1,82 @@
+from threading import Lock
+from typing import Callable
+
+from Database import DatabasePool, DatabaseWriter
+
+
+class Groups():
+    # Membership of every group used since startup, kept in memory so a
+    # group message does not read group_members each time. Changes go through
+    # the DatabaseWriter first and are applied here once committed
+    def __init__(self, database_pool: DatabasePool, database_writer: DatabaseWriter):
+        self.database_pool = database_pool
+        self.database_writer = database_writer
+        self.lock = Lock()
+        self.members: dict[str, frozenset[str]] = {}
+        # Bumped on every change so a load that raced with one is not cached
+        self.generation = 0
+        # Called with the group name after each change, for other shards
+        self.changed: Callable[[str], None] | None = None
+
+    def create(self, group_name: str, owner_username: str) -> bool:
+        if not group_name.startswith("#") or len(group_name) < 2:
+            return False
+        if not self.database_writer.createGroup(group_name, owner_username):
+            return False
+        with self.lock:
+            self.generation += 1
+            self.members[group_name] = frozenset((owner_username,))
+        self.notify(group_name)
+        return True
+
+    def join(self, group_name: str, username: str) -> bool:
+        if not self.database_writer.addGroupMember(group_name, username):
+            return False
+        with self.lock:
+            self.generation += 1
+            members = self.members.get(group_name)
+            if members is not None:
+                self.members[group_name] = members | {username}
+        self.notify(group_name)
+        return True
+
+    def leave(self, group_name: str, username: str):
+        self.database_writer.removeGroupMember(group_name, username)
+        with self.lock:
+            self.generation += 1
+            members = self.members.get(group_name)
+            if members is not None:
+                self.members[group_name] = members - {username}
+        self.notify(group_name)
+
+    def invalidate(self, group_name: str):
+        # Changed by another shard; reloaded from the database on next use
+        with self.lock:
+            self.generation += 1
+            self.members.pop(group_name, None)
+
+    def notify(self, group_name: str):
+        if self.changed is not None:
+            self.changed(group_name)
+
+    def getMembers(self, group_name: str) -> frozenset[str] | None:
+        # Sets are replaced, never changed in place, so callers can iterate
+        # the returned one without holding the lock
+        with self.lock:
+            members = self.members.get(group_name)
+            generation = self.generation
+        if members is not None:
+            return members
+
+        with self.database_pool.reader() as database:
+            loaded: list[str] | None = database.getGroupMembers(group_name)
+        if loaded is None:
+            return None
+        with self.lock:
+            if generation != self.generation:
+                return frozenset(loaded)
+            return self.members.setdefault(group_name, frozenset(loaded))
+
+    def isMember(self, group_name: str, username: str) -> bool:
+        members = self.getMembers(group_name)
+        return members is not None and username in members
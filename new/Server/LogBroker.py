@@ -0,0 +1,173 @@
+from threading import Thread, Event
+from queue import Queue, Empty
+from typing import Any
+import json
+import time
+import os
+
+from Broker import MemoryBroker
+from Metrics import metrics
+from Log import getLogger
+from Protocol import HEADER, encode
+
+log = getLogger(__name__)
+
+# The message fields written to the log; anything else on the dict is in-process only
+FIELDS = ("id", "timestamp", "sender_username", "receiver_username", "message", "group_name")
+
+
+class LogBroker(MemoryBroker):
+    # A MemoryBroker that also appends every change to a log file and replays
+    # it at startup. Records use the wire framing (length + JSON):
+    #   {"op": "publish", "messages": [...]}
+    #   {"op": "ack", "username": ..., "ids": [...]}
+    #   {"op": "ids", "ceiling": n}
+    # A writer thread appends them in batches with one flush and fsync per
+    # batch. Once the log holds many more records than there are messages
+    # waiting, it is rewritten as just the waiting messages
+    def __init__(self, path: str = "messages.log", fsync: bool = True, max_batch_size: int = 500, max_delay: float = 0.05, compact_records: int = 100000):
+        super(LogBroker, self).__init__()
+        self.path = path
+        self.fsync = fsync
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.compact_records = compact_records
+        self.records: Queue[tuple[str, Any]] = Queue()
+        self.writer = Thread(target=self.run, daemon=True)
+        self.running = True
+        self.write_timer = metrics.timer("broker.log_write", every=1)
+
+        # Above the log and the clock, in case the log is new but clients
+        # have seen ids from another backend
+        floor, self.written = self.replay()
+        self.startIds(max(floor, self.id_ceiling))
+        self.file = open(self.path, "ab")
+
+    def replay(self) -> tuple[int, int]:
+        # Rebuilds the queues from the log; returns the highest id seen and
+        # how many records there were. A record cut short by a crash is dropped
+        floor = 0
+        records = 0
+        if not os.path.exists(self.path):
+            return floor, records
+
+        with open(self.path, "rb") as file:
+            data: bytes = file.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            (length,) = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + length
+            if end > len(data):
+                break
+            try:
+                record: dict = json.loads(data[offset + HEADER.size:end])
+            except ValueError:
+                break
+            match(record["op"]):
+                case "publish":
+                    self.store(record["messages"])
+                    floor = max([floor] + [message["id"] for message in record["messages"]])
+                case "ack":
+                    self.remove(record["ids"], record["username"])
+                case "ids":
+                    floor = max(floor, record["ceiling"])
+            records += 1
+            offset = end
+
+        if offset < len(data):
+            log.warning("log_truncated", path=self.path, offset=offset, dropped=len(data) - offset)
+            with open(self.path, "r+b") as file:
+                file.truncate(offset)
+        return floor, records
+
+    def start(self):
+        self.writer.start()
+
+    def reserveIds(self, ceiling: int):
+        self.records.put(("record", encode({"op": "ids", "ceiling": ceiling})))
+        self.flush()
+
+    def publish(self, messages: list[dict]):
+        data: bytes = encode({"op": "publish", "messages": [{field: message[field] for field in FIELDS} for message in messages]})
+        # Queued under the same lock as the change, so the log has the same order
+        with self.lock:
+            self.store(messages)
+            self.records.put(("record", data))
+
+    def ack(self, message_ids: list[int], username: str):
+        with self.lock:
+            removed: list[int] = self.remove(message_ids, username)
+            if removed:
+                self.records.put(("record", encode({"op": "ack", "username": username, "ids": removed})))
+
+    def flush(self):
+        # pending sees a publish straight away (sync stays a no-op); this
+        # waits until everything queued so far is on disk
+        done = Event()
+        self.records.put(("flush", done))
+        done.wait()
+
+    def run(self):
+        while self.running:
+            batch: list[tuple[str, Any]] = [self.records.get()]
+            deadline: float = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size and batch[-1][0] == "record":
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.records.get(timeout=timeout))
+                except Empty:
+                    break
+            self.writeBatch(batch)
+        self.file.close()
+
+    def writeBatch(self, batch: list[tuple[str, Any]]):
+        records: list[bytes] = [payload for operation, payload in batch if operation == "record"]
+        try:
+            if records:
+                with self.write_timer():
+                    self.file.write(b"".join(records))
+                    self.file.flush()
+                    if self.fsync:
+                        os.fsync(self.file.fileno())
+                self.written += len(records)
+            if self.written > max(self.compact_records, 4 * self.stored):
+                self.compact()
+        except OSError:
+            log.exception("log_write_failed", path=self.path, records=len(records))
+
+        for operation, payload in batch:
+            match(operation):
+                case "flush":
+                    payload.set()
+                case "stop":
+                    self.running = False
+
+    def compact(self):
+        # Runs on the writer thread, between batches. Changes queued but not
+        # yet written are already in the snapshot or cancel out on replay,
+        # since replaying a publish or an ack twice changes nothing
+        with self.lock:
+            messages: list[dict] = [message for queue in self.queues.values() for message in queue.values()]
+        ceiling: int = self.id_ceiling
+        records: list[bytes] = [encode({"op": "ids", "ceiling": ceiling})]
+        for start in range(0, len(messages), 1000):
+            records.append(encode({"op": "publish", "messages": [{field: message[field] for field in FIELDS} for message in messages[start:start + 1000]]}))
+
+        with open(self.path + ".compact", "wb") as file:
+            file.write(b"".join(records))
+            file.flush()
+            os.fsync(file.fileno())
+        self.file.close()
+        try:
+            os.replace(self.path + ".compact", self.path)
+        finally:
+            self.file = open(self.path, "ab")
+        log.info("log_compacted", path=self.path, records=self.written, messages=len(messages))
+        self.written = len(records)
+
+    def stop(self):
+        # Writes out whatever is still queued before the thread exits
+        self.records.put(("stop", None))
+        self.writer.join()
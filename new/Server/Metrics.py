@@ -0,0 +1,226 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Event
+from typing import Callable
+import bisect
+import json
+import os
+import time
+
+from Log import getLogger
+
+log = getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds: 10us doubling up to ~80s
+BUCKETS: list[float] = [0.00001 * 2 ** index for index in range(24)]
+
+
+class Histogram():
+    def __init__(self):
+        self.lock = Lock()
+        self.counts: list[int] = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index: int = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counts, count, total, maximum = list(self.counts), self.count, self.total, self.max
+        return {
+            "count": count,
+            "mean": total / count if count else None,
+            "p50": self.quantile(counts, count, maximum, 0.50),
+            "p99": self.quantile(counts, count, maximum, 0.99),
+            "p999": self.quantile(counts, count, maximum, 0.999),
+            "max": maximum if count else None
+        }
+
+    def quantile(self, counts: list[int], count: int, maximum: float, fraction: float) -> float | None:
+        # Upper bound of the bucket the quantile falls in, capped at the largest value seen
+        if not count:
+            return None
+        rank: float = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKETS[index], maximum) if index < len(BUCKETS) else maximum
+        return None
+
+
+class Timing():
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class NoTiming():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_TIMING = NoTiming()
+
+
+class Sampler():
+    # True for one call in every `every`. The counter is not locked, so under
+    # contention a sample may be skipped, which is fine for statistics
+    def __init__(self, every: int):
+        self.every = every
+        self.calls = 0
+
+    def __call__(self) -> bool:
+        self.calls += 1
+        return self.calls % self.every == 0
+
+
+class Timer():
+    # Times one call in every `every`; the rest only pay for the sampler
+    def __init__(self, histogram: Histogram, every: int):
+        self.histogram = histogram
+        self.sampler = Sampler(every)
+
+    def __call__(self) -> Timing | NoTiming:
+        if self.sampler():
+            return Timing(self.histogram)
+        return NO_TIMING
+
+
+class Metrics():
+    # Process-wide registry. Counters and histograms are updated on the hot
+    # paths; gauges are functions only evaluated when a snapshot is taken
+    def __init__(self):
+        self.lock = Lock()
+        self.started: float = time.time()
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.gauges: dict[str, Callable[[], float | int | None]] = {}
+        self.last_counters: dict[str, int] = {}
+        self.last_snapshot: float = time.monotonic()
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        self.histogram(name).observe(value)
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def timer(self, name: str, every: int = 16) -> Timer:
+        return Timer(self.histogram(name), every)
+
+    def gauge(self, name: str, function: Callable[[], float | int | None]):
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self) -> dict:
+        now: float = time.monotonic()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(self.histograms)
+            elapsed: float = now - self.last_snapshot
+            # Per second since the previous snapshot
+            rates = {name: (value - self.last_counters.get(name, 0)) / elapsed for name, value in counters.items()} if elapsed > 0 else {}
+            self.last_counters = counters
+            self.last_snapshot = now
+
+        gauge_values: dict = {}
+        for name, function in gauges.items():
+            try:
+                gauge_values[name] = function()
+            except Exception:
+                gauge_values[name] = None
+                log.exception("gauge_failed", gauge=name)
+
+        return {
+            "timestamp": time.time(),
+            "uptime": time.time() - self.started,
+            "counters": counters,
+            "rates": {name: round(rate, 2) for name, rate in rates.items()},
+            "gauges": gauge_values,
+            "histograms": {name: histogram.snapshot() for name, histogram in histograms.items()}
+        }
+
+
+metrics = Metrics()
+
+
+class MetricsReporter(Thread):
+    # Takes a snapshot every interval, writes it to path (replaced atomically
+    # so readers never see half a file) and serves the latest one as JSON on
+    # 127.0.0.1:port. Requests never compute anything themselves
+    def __init__(self, interval: float = 5.0, path: str | None = None, port: int | None = None):
+        super(MetricsReporter, self).__init__(daemon=True)
+        self.interval = interval
+        self.path = path
+        self.port = port
+        self.stopped = Event()
+        self.latest: bytes = b"{}"
+        self.http: ThreadingHTTPServer | None = None
+
+    def run(self):
+        if self.port is not None:
+            self.http = ThreadingHTTPServer(("127.0.0.1", self.port), self.makeHandler())
+            Thread(target=self.http.serve_forever, daemon=True).start()
+
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        self.latest = json.dumps(metrics.snapshot(), sort_keys=True).encode()
+        if self.path is not None:
+            try:
+                with open(self.path + ".tmp", "wb") as file:
+                    file.write(self.latest)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                log.error("snapshot_write_failed", path=self.path, error=str(e))
+
+    def makeHandler(self) -> type:
+        reporter = self
+
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(reporter.latest)))
+                self.end_headers()
+                self.wfile.write(reporter.latest)
+
+            def log_message(self, format, *args):
+                pass
+
+        return StatsHandler
+
+    def stop(self):
+        self.stopped.set()
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+        self.report()
@@ -0,0 +1,72 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore
+import hashlib
+import base64
+import hmac
+import os
+
+# Stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>", so the cost can be
+# raised later without breaking existing rows
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 600000
+SALT_SIZE = 16
+
+
+def hashPassword(password: str, iterations: int = ITERATIONS, salt: bytes | None = None) -> str:
+    salt = os.urandom(SALT_SIZE) if salt is None else salt
+    digest: bytes = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{ALGORITHM}${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+
+def verifyPassword(password: str, stored: str) -> bool:
+    if not isHashed(stored):
+        # Rows written before passwords were hashed
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, iterations, salt, digest = stored.split("$")
+    expected: bytes = base64.b64decode(digest)
+    actual: bytes = hashlib.pbkdf2_hmac("sha256", password.encode(), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(actual, expected)
+
+
+def isHashed(stored: str) -> bool:
+    return stored.startswith(ALGORITHM + "$")
+
+
+def needsUpgrade(stored: str, iterations: int = ITERATIONS) -> bool:
+    return not isHashed(stored) or int(stored.split("$")[1]) < iterations
+
+
+class PasswordHasher():
+    # Hashing takes a few hundred milliseconds of CPU, so it runs on a few
+    # worker threads (hashlib releases the GIL) instead of the connection that
+    # asked. At most max_queue jobs wait; past that callers are told the server
+    # is busy rather than piling up behind a reconnect storm
+    def __init__(self, max_workers: int = 2, max_queue: int = 64, iterations: int = ITERATIONS):
+        self.iterations = iterations
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password")
+        self.slots = BoundedSemaphore(max_workers + max_queue)
+
+    def hash(self, password: str) -> Future | None:
+        return self.submit(hashPassword, password, self.iterations)
+
+    def verify(self, password: str, stored: str) -> Future | None:
+        # Resolves to (valid, upgraded hash or None)
+        return self.submit(self.verifyAndUpgrade, password, stored)
+
+    def verifyAndUpgrade(self, password: str, stored: str) -> tuple[bool, str | None]:
+        if not verifyPassword(password, stored):
+            return False, None
+        if needsUpgrade(stored, self.iterations):
+            return True, hashPassword(password, self.iterations)
+        return True, None
+
+    def submit(self, function, *args) -> Future | None:
+        # None when the queue is full
+        if not self.slots.acquire(blocking=False):
+            return None
+        future: Future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def stop(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
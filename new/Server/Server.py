@@ -1,28 +1,134 @@
-from ServerThread import IncomingMessages, ServerThread, Connection
-from Database import Database
+import socket
+import sys
+from typing import Literal
+from ServerThread import IncomingMessages, ServerThread
+from AsyncServer import AsyncServer
+from Database import Database, DatabasePool, DatabaseWriter
+from Broker import Broker, SQLiteBroker, MemoryBroker
+from LogBroker import LogBroker
+from Directory import UserDirectory
+from Passwords import PasswordHasher, ITERATIONS
+from Tokens import TokenManager
+from Groups import Groups
+from Backpressure import Backpressure, Policy
+from Metrics import metrics, MetricsReporter
+from Log import getLogger, setupLogging
+from Sessions import Sessions
+from Shards import ShardRouter, ShardedServer, openListener
+
+log = getLogger(__name__)
 
 
 class Server:
-    def __init__(self, ip: str, port: int):
-        self.clients_list: list[Connection] = []
+    def __init__(self, ip: str, port: int, engine: Literal["thread", "asyncio"] = "thread", max_batch_size: int = 500, max_batch_delay: float = 0.05, database_readers: int = 4, hash_workers: int = 2, hash_queue: int = 64, hash_iterations: int = ITERATIONS, send_high_water: int = 1024 * 1024, slow_consumer: Policy = "spill", metrics_interval: float = 5.0, metrics_file: str | None = None, metrics_port: int | None = None, log_level: str = "INFO", log_file: str | None = None, log_json: bool = False, shard: int = 0, shards: int = 1, listen_socket: socket.socket | None = None, bus_directory: str = "shards", bus_port: int | None = None, broker: Literal["sqlite", "memory", "log"] = "sqlite", broker_path: str = "messages.log"):
+        # shard/shards are set by ShardedServer when this is one of several
+        # processes on the same port and database
+        self.logHandler = setupLogging(log_level, log_file, log_json)
+        self.sessions = Sessions()
         self.ip, self.port = ip, port
+        self.engine = engine
+        self.shard, self.shards = shard, shards
         self.database = Database()
-        self.serverThread: ServerThread
+        self.database.initDatabase()
+        self.databasePool = DatabasePool(database_readers)
+        self.databaseWriter = DatabaseWriter(max_batch_size, max_batch_delay)
+        # Shards share stored messages through the database, so the other
+        # brokers, which each keep their own, only run unsharded
+        if broker != "sqlite" and shards > 1:
+            raise ValueError(f"The {broker} broker cannot be used with shards")
+        self.broker: Broker
+        match(broker):
+            case "sqlite":
+                # Each shard takes every shards-th id from its own offset, so
+                # id % shards is the shard whose writer stored a message
+                self.broker = SQLiteBroker(self.databaseWriter, self.databasePool, shard, shards)
+            case "memory":
+                self.broker = MemoryBroker()
+            case "log":
+                self.broker = LogBroker(broker_path, max_batch_size=max_batch_size, max_delay=max_batch_delay)
+            case _:
+                raise ValueError(f"Unknown message broker: {broker}")
+        self.userDirectory = UserDirectory(self.databasePool)
+        self.passwordHasher = PasswordHasher(hash_workers, hash_queue, hash_iterations)
+        self.tokenManager = TokenManager(self.database, self.databaseWriter)
+        self.groups = Groups(self.databasePool, self.databaseWriter)
+        self.backpressure = Backpressure(send_high_water, policy=slow_consumer)
+        self.listenSocket = listen_socket
+        self.router: ShardRouter | None = None
+        if shards > 1:
+            self.router = ShardRouter(shard, shards, bus_directory, port + 1000 if bus_port is None else bus_port, self.sessions, self.broker, self.userDirectory, self.groups, self.tokenManager)
+            if self.listenSocket is None:
+                self.listenSocket = openListener(ip, port, True)
+            # Each shard reports on its own port and file
+            metrics_port = None if metrics_port is None else metrics_port + shard
+            metrics_file = None if metrics_file is None else f"{metrics_file}.{shard}"
+        self.serverThread: ServerThread | AsyncServer
         self.incomingMessagesThread: IncomingMessages
+        # Only started when something reads the snapshots
+        self.metricsReporter: MetricsReporter | None = None
+        if metrics_file is not None or metrics_port is not None:
+            self.metricsReporter = MetricsReporter(metrics_interval, metrics_file, metrics_port)
 
         self.openServer()
 
     def openServer(self):
-        self.serverThread = ServerThread(self.ip, self.port, self.clients_list, self.database)
-        self.serverThread.start()
+        self.databaseWriter.start()
+        self.broker.start()
 
-        self.incomingMessagesThread = IncomingMessages(self.clients_list, self.database)
+        self.incomingMessagesThread = IncomingMessages(self.sessions, self.broker, router=self.router)
         self.incomingMessagesThread.start()
+        if self.router is not None:
+            self.router.start(self.incomingMessagesThread)
+
+        match(self.engine):
+            case "thread":
+                self.serverThread = ServerThread(self.ip, self.port, self.sessions, self.databasePool, self.incomingMessagesThread, self.databaseWriter, self.broker, self.userDirectory, self.passwordHasher, self.tokenManager, self.groups, self.backpressure, self.listenSocket)
+            case "asyncio":
+                self.serverThread = AsyncServer(self.ip, self.port, self.sessions, self.databasePool, self.incomingMessagesThread, self.databaseWriter, self.broker, self.userDirectory, self.passwordHasher, self.tokenManager, self.groups, self.backpressure, self.listenSocket)
+            case _:
+                raise ValueError(f"Unknown server engine: {self.engine}")
+        self.serverThread.start()
+        log.info("server_started", engine=self.engine, address=f"{self.ip}:{self.port}", shard=f"{self.shard + 1}/{self.shards}")
+
+        self.registerGauges()
+        if self.metricsReporter is not None:
+            self.metricsReporter.start()
+
+    def registerGauges(self):
+        metrics.gauge("connections", lambda: len(self.sessions.getConnections()))
+        metrics.gauge("users_online", lambda: len(self.sessions.users))
+        metrics.gauge("incoming_backlog", self.broker.backlog)
+        metrics.gauge("writer_queue", self.databaseWriter.operations.qsize)
+        metrics.gauge("delivery_queue", self.incomingMessagesThread.events.qsize)
+        metrics.gauge("in_flight", lambda: len(self.incomingMessagesThread.in_flight))
+        metrics.gauge("send_queue_bytes", lambda: sum(connection.queuedBytes() for connection in self.sessions.getConnections()))
+        metrics.gauge("send_queue_bytes_max", lambda: max((connection.queuedBytes() for connection in self.sessions.getConnections()), default=0))
+        metrics.gauge("log_dropped", lambda: self.logHandler.dropped)
+
+    def revokeSessions(self, username: str):
+        # Invalidates every token the user holds and drops their live connections
+        self.tokenManager.revokeUser(username)
+        for connection in self.sessions.get(username):
+            connection.close()
 
     def closeServer(self):
+        if self.metricsReporter is not None:
+            self.metricsReporter.stop()
         self.serverThread.stop()
+        self.passwordHasher.stop()
         self.incomingMessagesThread.stop()
+        if self.router is not None:
+            self.router.stop()
+        self.broker.stop()
+        self.databaseWriter.stop()
+        self.databasePool.close()
+        log.info("server_stopped")
 
 
 if __name__ == "__main__":
-    server = Server("localhost", 5000)
+    engine = sys.argv[1] if len(sys.argv) > 1 else "thread"
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    if shards > 1:
+        server = ShardedServer("localhost", 5000, shards, engine=engine)
+    else:
+        server = Server("localhost", 5000, engine)
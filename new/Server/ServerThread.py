@@ -1,57 +1,341 @@
-from typing import Mapping
-from Database import Database
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+from Database import DatabasePool, DatabaseWriter
+from Broker import Broker, clientId
+from Directory import UserDirectory
+from Passwords import PasswordHasher
+from Tokens import TokenManager
+from Groups import Groups
+from Backpressure import Backpressure
+from Metrics import metrics, Sampler
+from Log import getLogger
+from Sessions import Sessions
+from Protocol import FrameDecoder, HEADER, MAX_FRAME_SIZE, encode
 
-from threading import Thread
+from threading import Thread, Condition
+from queue import Queue, Empty
+from collections import deque
+from contextlib import nullcontext
 import socket
+import itertools
+import heapq
 import json
+import time
+
+log = getLogger(__name__)
+connection_ids = itertools.count(1)
+# Shared by every connection so the 1-in-16 sampling spans all logins
+login_timer = metrics.timer("db.password_lookup")
+
+# encodeMessages joins messages encoded one at a time into the bytes encode()
+# would give for the whole page
+PAGE_OPEN = b'{"type": "user_messages", "messages": ['
+PAGE_SEPARATOR = b", "
+PAGE_CLOSE = b"]}"
+# Message text is refused once its JSON is bigger than this, leaving room in a
+# frame for the fields the server adds when it sends it on
+MAX_MESSAGE_SIZE = MAX_FRAME_SIZE - 64 * 1024
 
 
 class IncomingMessages(Thread):
-    def __init__(self, clients_list: list["Connection"], database: Database):
+    def __init__(self, sessions: Sessions, broker: Broker, page_size: int = 1000, ack_timeout: float = 10.0, max_attempts: int = 5, router: "ShardRouter | None" = None):
         super(IncomingMessages, self).__init__()
-        self.clients_list = clients_list
-        self.database = database
+        self.sessions = sessions
+        self.broker = broker
+        # Set when running as one shard of several; messages for users on
+        # other shards are handed to it
+        self.router = router
+        self.page_size = page_size
+        self.events: Queue[tuple[str, Any]] = Queue()
         self.running = True
 
+        # Sent but not yet acknowledged, keyed by (id, receiver) since every
+        # member gets a group copy under the same id, stored or not. Messages
+        # stay in the broker until the receiver acks them, and are resent when
+        # ack_timeout expires. Group copies sent live were never stored, so one
+        # its member does not ack is stored for them when it is given up on
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.in_flight: dict[tuple[int, str], tuple[dict, float, int]] = {}
+        self.deadlines: list[tuple[float, tuple[int, str]]] = []
+        self.backlog_timer = metrics.timer("db.backlog_page", every=1)
+        self.latency_sampler = Sampler(16)
+        # Backlog is read, encoded and queued here, so a long flush never holds
+        # up live delivery; only its tracking comes back through the events
+        self.flusher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backlog")
+
     def run(self):
+        # Blocks until a Connection pushes work or a retry is due, so an idle server costs no CPU
         while self.running:
-            messages = self.database.getMessages()
-            for message in messages:
-                for client in self.clients_list:
-                    if client.getUsername() == message["receiver_username"]:
-                        try:
-                            client.getSocket().send(json.dumps({
-                                "type": "user_message",
-                                "sender_username": message["sender_username"],
-                                "receiver_username": message["receiver_username"],
-                                "message": message["message"],
-                                "timestamp": message["timestamp"]
-                            }).encode())
-                            self.database.removeMessage(message["id"])
-                        except Exception as e:
-                            print(f"Error sending message to {client.getUsername()}: {e}")
+            self.retryMessages()
+            try:
+                event, payload = self.events.get(timeout=self.nextTimeout())
+            except Empty:
+                continue
+            try:
+                self.handleEvent(event, payload)
+            except Exception:
+                # One bad event must not stop delivery for everyone
+                log.exception("delivery_failed", kind=event)
+
+    def handleEvent(self, event: str, payload: Any):
+        match(event):
+            case "message":
+                self.sendMessage(payload)
+            case "group":
+                self.sendGroupMessage(*payload)
+            case "routed_message":
+                self.sendMessage(payload, False)
+            case "routed_group":
+                self.sendGroupMessage(*payload, False)
+            case "track":
+                for message in payload:
+                    self.track(message, message["receiver_username"])
+            case "ack":
+                self.ackMessages(*payload)
+            case "stop":
+                self.running = False
+                for (_, username), (message, _, _) in list(self.in_flight.items()):
+                    if message["receiver_username"] != username:
+                        self.release(message, username)
+
+    def deliver(self, message: dict):
+        self.events.put(("message", message))
+
+    def deliverGroup(self, message: dict, members: frozenset[str]):
+        self.events.put(("group", (message, members)))
+
+    def deliverRouted(self, message: dict):
+        # From another shard, which already stored it
+        self.events.put(("routed_message", message))
+
+    def deliverRoutedGroup(self, message: dict, members: list[str]):
+        self.events.put(("routed_group", (message, members)))
+
+    def flush(self, connection: "ClientHandler"):
+        try:
+            self.flusher.submit(self.flushMessages, connection)
+        except RuntimeError:
+            # The flusher is shut down, so the server is stopping
+            pass
+
+    def ack(self, username: str, message_ids: list[int]):
+        self.events.put(("ack", (username, message_ids)))
+
+    def sendMessage(self, message: dict, route: bool = True):
+        if route and self.router is not None:
+            self.router.routeMessage(message)
+        clients = self.sessions.get(message["receiver_username"])
+        if not clients:
+            return
+
+        data: bytes = encode(self.formatMessage(message))
+        if self.sendData(clients, data):
+            self.track(message, message["receiver_username"])
+            metrics.increment("messages_out")
+            if self.latency_sampler():
+                metrics.observe("delivery_latency", time.perf_counter() - message["received_at"])
+
+    def sendGroupMessage(self, message: dict, members: frozenset[str] | list[str], route: bool = True):
+        # Encoded once for every member; sendData only queues it on each
+        # connection, so a large group costs one pass over the member set.
+        # Members with no connection get a stored copy, all in one insert
+        data: bytes = encode(self.formatMessage(message))
+        connections = self.sessions.getMany(members)
+        # Members online on other shards get it from there, which stores the
+        # copy if they have gone by the time it arrives
+        elsewhere: set[str] = set()
+        if route and self.router is not None:
+            elsewhere = self.router.routeGroupMessage(message, members)
+        offline: list[str] = []
+        delivered = 0
+        for username in members:
+            if username == message["sender_username"]:
+                continue
+            clients = connections.get(username)
+            if clients and self.sendData(clients, data):
+                self.track(message, username)
+                delivered += 1
+            elif username not in elsewhere:
+                offline.append(username)
+        metrics.increment("messages_out", delivered)
+        if offline:
+            self.broker.storeGroupMessage(message, offline)
+
+    def flushMessages(self, connection: "ClientHandler"):
+        # Runs on the flusher. Backlog stored while the user was offline is only
+        # read once, at login, a page at a time and sent as few frames per page as fit
+        try:
+            pages = self.broker.subscribe(connection.getUsername(), self.page_size)
+            while self.running:
+                with self.backlog_timer():
+                    messages: list[dict] | None = next(pages, None)
+                if messages is None:
+                    break
+
+                for data, batch in self.encodeMessages(messages):
+                    # Tracked before it is queued so its ack cannot be handled
+                    # first; a frame the connection refuses is retried like any other
+                    self.events.put(("track", batch))
+                    if not self.sendData([connection], data):
+                        return
+                    metrics.increment("messages_out", len(batch))
+        except Exception:
+            connection.log.exception("flush_failed")
+
+    def ackMessages(self, username: str, message_ids: list[int]):
+        for message_id in message_ids:
+            self.in_flight.pop((message_id, username), None)
+        metrics.increment("acks", len(message_ids))
+        if self.router is not None:
+            # The row may still be queued on the writer of the shard that stored it
+            self.router.removeMessages(message_ids, username)
+        else:
+            self.broker.ack(message_ids, username)
+
+    def track(self, message: dict, username: str, attempts: int = 1):
+        deadline = time.monotonic() + self.ack_timeout * attempts
+        self.in_flight[(clientId(message), username)] = (message, deadline, attempts)
+        heapq.heappush(self.deadlines, (deadline, (clientId(message), username)))
+
+    def release(self, message: dict, username: str):
+        # Stops waiting for an ack. A stored message stays in the broker for
+        # the next login; a live group copy is stored for the member now
+        del self.in_flight[(clientId(message), username)]
+        if message["receiver_username"] != username:
+            self.broker.storeGroupMessage(message, [username])
+
+    def nextTimeout(self) -> float | None:
+        if not self.deadlines:
+            return None
+        return max(0, self.deadlines[0][0] - time.monotonic())
+
+    def retryMessages(self):
+        now = time.monotonic()
+        expired: dict[str, list[tuple[dict, int]]] = {}
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            entry = self.in_flight.get(key)
+            # Acked, or re-tracked with a later deadline since this one was pushed
+            if entry is None or entry[1] != deadline:
+                continue
+            message, _, attempts = entry
+            if attempts >= self.max_attempts:
+                self.release(message, key[1])
+                continue
+            expired.setdefault(key[1], []).append((message, attempts))
+
+        for username, entries in expired.items():
+            clients = self.sessions.get(username)
+            attempts: dict[int, int] = {message["id"]: count for message, count in entries}
+            if clients:
+                for data, batch in self.encodeMessages([message for message, _ in entries]):
+                    if not self.sendData(clients, data):
+                        break
+                    metrics.increment("messages_retried", len(batch))
+                    for message in batch:
+                        self.track(message, username, attempts.pop(message["id"]) + 1)
+            # Whatever was not sent again is given up on
+            for message, _ in entries:
+                if message["id"] in attempts:
+                    self.release(message, username)
+
+    def formatMessage(self, message: dict) -> dict:
+        if message.get("group_name"):
+            # Stored copies are addressed to the member, but the client files them under the group
+            return {
+                "type": "group_message",
+                "id": clientId(message),
+                "sender_username": message["sender_username"],
+                "receiver_username": message["group_name"],
+                "message": message["message"],
+                "timestamp": message["timestamp"]
+            }
+        return {
+            "type": "user_message",
+            "id": clientId(message),
+            "sender_username": message["sender_username"],
+            "receiver_username": message["receiver_username"],
+            "message": message["message"],
+            "timestamp": message["timestamp"]
+        }
+
+    def encodeMessages(self, messages: list[dict]) -> list[tuple[bytes, list[dict]]]:
+        # user_messages frames, each with the messages it carries, split by
+        # encoded size so that no frame goes over MAX_FRAME_SIZE
+        frames: list[tuple[bytes, list[dict]]] = []
+        parts: list[bytes] = []
+        batch: list[dict] = []
+        size = len(PAGE_OPEN) + len(PAGE_CLOSE)
+        for message in messages:
+            part: bytes = json.dumps(self.formatMessage(message)).encode()
+            if len(PAGE_OPEN) + len(part) + len(PAGE_CLOSE) > MAX_FRAME_SIZE:
+                # Only stored before sendUserMessage refused text this long
+                log.error("message_too_large", id=message["id"], size=len(part))
+                continue
+            if batch and size + len(PAGE_SEPARATOR) + len(part) > MAX_FRAME_SIZE:
+                frames.append((self.joinPage(parts), batch))
+                parts, batch, size = [], [], len(PAGE_OPEN) + len(PAGE_CLOSE)
+            size += len(part) + (len(PAGE_SEPARATOR) if parts else 0)
+            parts.append(part)
+            batch.append(message)
+        if batch:
+            frames.append((self.joinPage(parts), batch))
+        return frames
+
+    def joinPage(self, parts: list[bytes]) -> bytes:
+        payload: bytes = PAGE_SEPARATOR.join(parts)
+        return b"".join((HEADER.pack(len(PAGE_OPEN) + len(payload) + len(PAGE_CLOSE)), PAGE_OPEN, payload, PAGE_CLOSE))
+
+    def sendData(self, clients: list["ClientHandler"], data: bytes) -> bool:
+        delivered = False
+        for client in clients:
+            try:
+                if client.deliver(data):
+                    delivered = True
+            except Exception:
+                client.log.exception("send_failed")
+        return delivered
 
     def stop(self):
-        self.running = False
+        # Waits, so unacked group copies are stored before the broker stops
+        self.events.put(("stop", None))
+        self.join()
+        # A flush still running stops at its next page
+        self.flusher.shutdown(cancel_futures=True)
 
 
 class ServerThread(Thread):
-    def __init__(self, ip: str, port: int, clients_list: list["Connection"], database: Database):
+    def __init__(self, ip: str, port: int, sessions: Sessions, database_pool: DatabasePool, incoming_messages: IncomingMessages, database_writer: DatabaseWriter, broker: Broker, user_directory: UserDirectory, password_hasher: PasswordHasher, token_manager: TokenManager, groups: Groups, backpressure: Backpressure, listen_socket: socket.socket | None = None):
         super(ServerThread, self).__init__()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients: list[Connection] = clients_list
-        self.database = database
+        # Shards are given a socket that is already listening
+        self.listening = listen_socket is not None
+        self.socket = listen_socket if listen_socket is not None else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sessions = sessions
+        self.database_pool = database_pool
+        self.incoming_messages = incoming_messages
+        self.database_writer = database_writer
+        self.broker = broker
+        self.user_directory = user_directory
+        self.password_hasher = password_hasher
+        self.token_manager = token_manager
+        self.groups = groups
+        self.backpressure = backpressure
         self.ip, self.port = ip, port
+        # Logins finish here once their password is hashed, off the hasher pool
+        self.executor = ThreadPoolExecutor(max_workers=database_pool.size, thread_name_prefix="session")
 
     def run(self):
-        self.socket.bind((self.ip, self.port))
+        if not self.listening:
+            self.socket.bind((self.ip, self.port))
+            self.socket.listen(1024)
         self.connected = True
-        self.socket.listen(1)
         try:
             while True:
                 self.client, self.addr = self.socket.accept()
-                self.connection_thread = Connection(self.client, self.clients, self.database)
-                self.clients.append(self.connection_thread)
+                self.connection_thread = Connection(self.client, self.sessions, self.database_pool, self.incoming_messages, self.database_writer, self.broker, self.user_directory, self.password_hasher, self.token_manager, self.groups, self.backpressure, self.executor)
+                self.sessions.add(self.connection_thread)
+                metrics.increment("connections_accepted")
                 self.connection_thread.start()
 
         except Exception:
@@ -60,81 +344,406 @@ class ServerThread(Thread):
     def stop(self):
         try:
             self.socket.close()
-            for client in self.clients:
-                client.getSocket().close()
+            for client in self.sessions.getConnections():
+                client.close()
         except AttributeError:
-            print("No Server opened - Closing")
+            log.warning("server_not_open", "No Server opened - Closing")
+        self.executor.shutdown(wait=False)
 
 
-class Connection(Thread):
-    def __init__(self, conn: socket.socket, clients_list: list["Connection"], database: Database):
-        super(Connection, self).__init__()
-        self.socket: socket.socket = conn
-        self.clients: list[Connection] = clients_list
-        self.database = Database()
-        self.connected = True
+class ClientHandler():
+    # Protocol logic shared by the thread and asyncio engines; subclasses provide
+    # the transport (sendData/close) and where deferred work runs (runLater)
+    def __init__(self, sessions: Sessions, database_pool: DatabasePool, incoming_messages: IncomingMessages, database_writer: DatabaseWriter, broker: Broker, user_directory: UserDirectory, password_hasher: PasswordHasher, token_manager: TokenManager, groups: Groups, backpressure: Backpressure):
+        self.sessions = sessions
+        self.database_pool = database_pool
+        self.incoming_messages = incoming_messages
+        self.database_writer = database_writer
+        self.broker = broker
+        self.user_directory = user_directory
+        self.password_hasher = password_hasher
+        self.token_manager = token_manager
+        self.groups = groups
+        self.backpressure = backpressure
+        self.spilled = False
+        # Guards the high-water check against the transport draining its queue
+        self.delivery_lock = nullcontext()
         self.username = ""
+        self.token = ""
+        self.connection_id: int = next(connection_ids)
+        self.log = log.bind(self.logContext)
 
-    def run(self):
-        print("Client connected")
-        while self.connected:
-            try:
-                text: str = self.socket.recv(1024).decode()
-                message: dict = json.loads(text)
-                match(message["type"]):
-                    case "register":
-                        self.registerUser(message)
-                    case "login":
-                        self.loginUser(message)
-                    case "message":
-                        self.database.addMessage(message["sender_username"], message["receiver_username"], message["message"])
-
-            except WindowsError:
-                print("Client disconnected")
-                self.connected = False
-            except json.JSONDecodeError:
-                print("Client disconnected")
-                self.connected = False
-            except Exception as e:
-                print(f"Server Error: {e}")
+    def handleMessage(self, message: dict):
+        match(message["type"]):
+            case "register":
+                self.registerUser(message)
+            case "login":
+                self.loginUser(message)
+            case "message":
+                if self.username:
+                    self.sendUserMessage(message)
+            case "ack":
+                if self.username:
+                    self.incoming_messages.ack(self.username, message["ids"])
+            case "resume":
+                self.resumeSession(message)
+            case "logout":
+                if self.username:
+                    self.logoutUser()
+            case "create_group":
+                if self.username:
+                    self.createGroup(message)
+            case "join_group":
+                if self.username:
+                    self.joinGroup(message)
+            case "leave_group":
+                if self.username:
+                    self.groups.leave(message["group_name"], self.username)
+            case "group_message":
+                if self.username:
+                    self.sendGroupMessage(message)
+            case "user_search":
+                self.searchUsers(message)
+            case "user_exists":
+                self.userExists(message)
 
     def loginUser(self, message: dict):
-
         username: str = message["username"]
         password: str = message["password"]
-        if (self.database.loginUser(username, password)):
-            send_message: dict = {
-                "type": "login",
-                "check": "success"
-            }
-            self.socket.send(json.dumps(send_message).encode())
-            self.username = message["username"]
-        else:
-            send_message: dict = {
-                "type": "login",
-                "check": "failure"
-            }
-            self.socket.send("failure".encode())
+        with self.database_pool.reader() as database, login_timer():
+            stored: str | None = database.getPassword(username)
+        if stored is None:
+            self.sendCheck("login", "failure")
+            return
+
+        # Finished by passwordVerified once the KDF is done, so this
+        # connection keeps reading while it runs
+        future = self.password_hasher.verify(password, stored)
+        if future is None:
+            self.sendCheck("login", "busy")
+            return
+        future.add_done_callback(lambda done: self.afterHash(self.passwordVerified, username, done))
+
+    def afterHash(self, function: Callable, *args):
+        # Called on a hasher thread. The pool is kept for the KDF alone; the
+        # rest of a login waits on the writer and, when sharded, on the other
+        # shards, so it is handed to the engine's executor
+        try:
+            self.runLater(function, *args)
+        except RuntimeError:
+            # The executor is shut down, so the server is stopping
+            pass
+
+    def runLogged(self, function: Callable, *args):
+        try:
+            function(*args)
+        except Exception:
+            self.log.exception("handler_failed")
+
+    def passwordVerified(self, username: str, future: Future):
+        try:
+            valid, upgraded = future.result()
+        except Exception:
+            self.log.exception("password_verify_failed", username=username)
+            valid, upgraded = False, None
+
+        if not valid:
+            self.sendCheck("login", "failure")
+            return
+        if upgraded is not None:
+            # Plaintext or weaker hash from an older server, replaced now that we know the password
+            self.database_writer.updatePassword(username, upgraded)
+        self.startSession("login", username)
 
     def registerUser(self, message: dict):
         username: str = message["username"]
         password: str = message["password"]
-        if (self.database.registerUser(username, password)):
-            send_message: dict = {
-                "type": "register",
-                "check": "success"
-            }
-            self.socket.send(json.dumps(send_message).encode())
-            self.username = message["username"]
-        else:
-            send_message: dict = {
-                "type": "register",
-                "check": "failure"
-            }
-            self.socket.send(json.dumps(send_message).encode())
+        # Taken names are turned away before spending a hash on them; "#" is
+        # reserved for group names
+        if username.startswith("#") or self.user_directory.exists(username):
+            self.sendCheck("register", "failure")
+            return
+
+        future = self.password_hasher.hash(password)
+        if future is None:
+            self.sendCheck("register", "busy")
+            return
+        future.add_done_callback(lambda done: self.afterHash(self.passwordHashed, username, done))
+
+    def passwordHashed(self, username: str, future: Future):
+        try:
+            registered: bool = self.database_writer.registerUser(username, future.result())
+        except Exception:
+            self.log.exception("register_failed", username=username)
+            registered = False
+
+        if not registered:
+            self.sendCheck("register", "failure")
+            return
+        self.user_directory.addUser(username)
+        self.startSession("register", username)
+
+    def resumeSession(self, message: dict):
+        # Reconnects skip the password entirely; the token is checked in memory
+        claims: dict | None = self.token_manager.verify(message["token"])
+        if claims is None:
+            self.sendCheck("resume", "failure")
+            return
+        self.startSession("resume", claims["username"], message["token"])
+
+    def startSession(self, message_type: str, username: str, token: str | None = None):
+        # The reply goes out before the session is bound, so it reaches the
+        # client ahead of any message delivered to it
+        token = self.token_manager.issue(username) if token is None else token
+        send_message: dict = {
+            "type": message_type,
+            "check": "success",
+            "username": username,
+            "token": token
+        }
+        self.send(send_message)
+        if self.sessions.login(username, self):
+            metrics.increment(f"sessions_{message_type}")
+            self.username = username
+            self.token = token
+            self.incoming_messages.flush(self)
+
+    def logoutUser(self):
+        claims: dict | None = self.token_manager.verify(self.token)
+        if claims is not None:
+            self.token_manager.revoke(claims)
+        self.sessions.logout(self)
+        self.username = ""
+        self.token = ""
+
+    def sendCheck(self, message_type: str, check: str):
+        send_message: dict = {
+            "type": message_type,
+            "check": check
+        }
+        self.send(send_message)
+
+    def searchUsers(self, message: dict):
+        prefix: str = message["prefix"]
+        send_message: dict = {
+            "type": "user_search",
+            "prefix": prefix,
+            "users": self.user_directory.search(prefix, message.get("limit"))
+        }
+        self.send(send_message)
+
+    def userExists(self, message: dict):
+        username: str = message["username"]
+        send_message: dict = {
+            "type": "user_exists",
+            "username": username,
+            "exists": self.user_directory.exists(username)
+        }
+        self.send(send_message)
+
+    def createGroup(self, message: dict):
+        group_name: str = message["group_name"]
+        send_message: dict = {
+            "type": "create_group",
+            "group_name": group_name,
+            "check": "success" if self.groups.create(group_name, self.username) else "failure"
+        }
+        self.send(send_message)
+
+    def joinGroup(self, message: dict):
+        group_name: str = message["group_name"]
+        send_message: dict = {
+            "type": "join_group",
+            "group_name": group_name,
+            "check": "success" if self.groups.join(group_name, self.username) else "failure"
+        }
+        self.send(send_message)
+
+    def sendGroupMessage(self, message: dict):
+        # Fan-out happens on the delivery thread, so the sender only pays for the membership check
+        group_name: str = message["group_name"]
+        members = self.groups.getMembers(group_name)
+        if members is None or self.username not in members or not self.checkSize(message):
+            return
+        group_message: dict = self.broker.addGroupMessage(self.username, group_name, message["message"])
+        metrics.increment("group_messages_in")
+        self.incoming_messages.deliverGroup(group_message, members)
+
+    def sendUserMessage(self, message: dict):
+        # The sender is whoever this connection logged in as; the
+        # sender_username clients still send is not trusted
+        if not self.checkSize(message):
+            return
+        stored: dict = self.broker.addMessage(self.username, message["receiver_username"], message["message"])
+        metrics.increment("messages_in")
+        # Not a column; the insert only binds the named parameters
+        stored["received_at"] = time.perf_counter()
+        self.incoming_messages.deliver(stored)
+
+    def checkSize(self, message: dict) -> bool:
+        # JSON takes at most 12 bytes for a character, so only text that could
+        # be too big is encoded to measure it
+        text: str = message["message"]
+        if len(text) * 12 <= MAX_MESSAGE_SIZE or len(json.dumps(text)) <= MAX_MESSAGE_SIZE:
+            return True
+        self.log.warning("message_too_large", length=len(text))
+        return False
+
+    def send(self, message: dict):
+        # Replies to the client's own requests skip the high-water check
+        self.sendData(encode(message))
+
+    def deliver(self, data: bytes) -> bool:
+        # Chat traffic; False when the frame was not queued and must be kept for later
+        with self.delivery_lock:
+            queued: int = self.queuedBytes()
+            if queued == 0 or queued + len(data) <= self.backpressure.high_water:
+                self.sendData(data)
+                return True
+            spill: bool = self.backpressure.policy == "spill" and not self.spilled
+            if spill:
+                self.spilled = True
+
+        metrics.increment(f"slow_consumer_{self.backpressure.policy}")
+        match(self.backpressure.policy):
+            case "drop":
+                return True
+            case "spill":
+                if spill:
+                    self.watchDrain()
+                return False
+            case "disconnect":
+                # Out of the sessions first so nothing else is routed to it
+                self.log.warning("slow_consumer_disconnected", queued=queued)
+                self.sessions.remove(self)
+                self.abort()
+                return False
+
+    def drained(self):
+        # Called by the transport once the queue is back under low_water
+        if self.spilled:
+            self.spilled = False
+            self.incoming_messages.flush(self)
+
+    def sendData(self, data: bytes):
+        raise NotImplementedError
+
+    def queuedBytes(self) -> int:
+        raise NotImplementedError
+
+    def watchDrain(self):
+        pass
+
+    def abort(self):
+        # Closes without writing out what is still queued
+        self.close()
+
+    def close(self):
+        raise NotImplementedError
+
+    def runLater(self, function: Callable, *args):
+        raise NotImplementedError
 
     def getUsername(self) -> str:
         return self.username
 
+    def logContext(self) -> dict:
+        return {"connection": self.connection_id, "user": self.username or None}
+
+
+class Connection(Thread, ClientHandler):
+    def __init__(self, conn: socket.socket, sessions: Sessions, database_pool: DatabasePool, incoming_messages: IncomingMessages, database_writer: DatabaseWriter, broker: Broker, user_directory: UserDirectory, password_hasher: PasswordHasher, token_manager: TokenManager, groups: Groups, backpressure: Backpressure, executor: ThreadPoolExecutor):
+        Thread.__init__(self)
+        ClientHandler.__init__(self, sessions, database_pool, incoming_messages, database_writer, broker, user_directory, password_hasher, token_manager, groups, backpressure)
+        self.socket: socket.socket = conn
+        self.executor = executor
+        self.connected = True
+        # Frames are written by their own thread, so whoever sends (delivery,
+        # group fan-out, this connection) never waits on a slow socket.
+        # outbound_bytes counts frames until they are fully sent
+        self.outbound: deque[bytes] = deque()
+        self.outbound_bytes = 0
+        self.outbound_ready = Condition()
+        # The writer checks spilled under this same lock once the queue drains
+        self.delivery_lock = self.outbound_ready
+        self.sender = Thread(target=self.writeFrames, daemon=True)
+
+    def run(self):
+        self.log.info("client_connected", peer=self.getPeer())
+        self.sender.start()
+        decoder = FrameDecoder()
+        while self.connected:
+            try:
+                for message in decoder.recv(self.socket):
+                    self.handleMessage(message)
+
+            except OSError:
+                self.connected = False
+            except ValueError as e:
+                self.log.warning("protocol_error", error=str(e))
+                self.connected = False
+            except Exception:
+                self.log.exception("handler_failed")
+
+        self.log.info("client_disconnected")
+
+        self.sessions.remove(self)
+        with self.outbound_ready:
+            self.outbound_ready.notify()
+        self.close()
+
+    def writeFrames(self):
+        low_water: int = self.backpressure.low_water
+        while True:
+            # Everything waiting, up to coalesce_size, goes out in one sendall
+            with self.outbound_ready:
+                while not self.outbound and self.connected:
+                    self.outbound_ready.wait()
+                if not self.connected:
+                    return
+                frames: list[bytes] = []
+                size = 0
+                while self.outbound and size < self.backpressure.coalesce_size:
+                    frame = self.outbound.popleft()
+                    frames.append(frame)
+                    size += len(frame)
+
+            try:
+                self.socket.sendall(frames[0] if len(frames) == 1 else b"".join(frames))
+            except OSError:
+                return
+
+            with self.outbound_ready:
+                self.outbound_bytes -= size
+                if self.spilled and self.outbound_bytes <= low_water:
+                    self.drained()
+
+    def sendData(self, data: bytes):
+        with self.outbound_ready:
+            self.outbound.append(data)
+            self.outbound_bytes += len(data)
+            self.outbound_ready.notify()
+
+    def queuedBytes(self) -> int:
+        return self.outbound_bytes
+
+    def runLater(self, function: Callable, *args):
+        self.executor.submit(self.runLogged, function, *args)
+
+    def close(self):
+        # shutdown() wakes the thread blocked in recv; close() alone does not
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def getPeer(self) -> str:
+        try:
+            host, port = self.socket.getpeername()[:2]
+            return f"{host}:{port}"
+        except OSError:
+            return ""
+
     def getSocket(self) -> socket.socket:
         return self.socket
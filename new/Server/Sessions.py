@@ -0,0 +1,83 @@
+from threading import Lock
+from typing import Callable
+
+
+class Sessions():
+    def __init__(self):
+        self.lock = Lock()
+        self.connections: set["Connection"] = set()
+        self.users: dict[str, set["Connection"]] = {}
+        # The username each connection is bound under. Kept here rather than
+        # read back from the connection, which only records it after login returns
+        self.bound: dict["Connection", str] = {}
+        # Called with (username, online, sequence) when a user's first
+        # connection logs in or their last one goes, for other shards. Calls
+        # happen outside the lock, so the sequence tells which one is newer
+        self.presence: Callable[[str, bool, int], None] | None = None
+        self.presence_sequence = 0
+
+    def add(self, connection: "Connection"):
+        with self.lock:
+            self.connections.add(connection)
+
+    def login(self, username: str, connection: "Connection") -> bool:
+        # Logins finish on another thread, so the connection may be gone already
+        changes: list[tuple[str, bool, int]] = []
+        with self.lock:
+            if connection not in self.connections:
+                return False
+            self._unbind(connection, changes)
+            sessions = self.users.setdefault(username, set())
+            if not sessions:
+                changes.append(self._change(username, True))
+            sessions.add(connection)
+            self.bound[connection] = username
+        self.notify(changes)
+        return True
+
+    def logout(self, connection: "Connection"):
+        # Stays connected, but no longer receives the user's messages
+        changes: list[tuple[str, bool, int]] = []
+        with self.lock:
+            self._unbind(connection, changes)
+        self.notify(changes)
+
+    def remove(self, connection: "Connection"):
+        changes: list[tuple[str, bool, int]] = []
+        with self.lock:
+            self._unbind(connection, changes)
+            self.connections.discard(connection)
+        self.notify(changes)
+
+    def get(self, username: str) -> list["Connection"]:
+        with self.lock:
+            return list(self.users.get(username, ()))
+
+    def getMany(self, usernames) -> dict[str, list["Connection"]]:
+        # One lock round for a whole group instead of one per member
+        with self.lock:
+            return {username: list(self.users[username]) for username in usernames if username in self.users}
+
+    def getConnections(self) -> list["Connection"]:
+        with self.lock:
+            return list(self.connections)
+
+    def notify(self, changes: list[tuple[str, bool, int]]):
+        if self.presence is not None:
+            for change in changes:
+                self.presence(*change)
+
+    def _unbind(self, connection: "Connection", changes: list[tuple[str, bool, int]]):
+        # Caller must hold the lock
+        username = self.bound.pop(connection, None)
+        sessions = self.users.get(username) if username is not None else None
+        if sessions is not None and connection in sessions:
+            sessions.discard(connection)
+            if not sessions:
+                del self.users[username]
+                changes.append(self._change(username, False))
+
+    def _change(self, username: str, online: bool) -> tuple[str, bool, int]:
+        # Caller must hold the lock
+        self.presence_sequence += 1
+        return (username, online, self.presence_sequence)
@@ -0,0 +1,318 @@
+from threading import Thread, Lock, Event
+import multiprocessing
+import itertools
+import socket
+import time
+import os
+
+from Database import Database
+from Broker import Broker
+from Directory import UserDirectory
+from Tokens import TokenManager, loadSecret
+from Groups import Groups
+from Metrics import metrics
+from Log import getLogger
+from Sessions import Sessions
+from Protocol import FrameDecoder, encode
+
+log = getLogger(__name__)
+
+
+def openListener(ip: str, port: int, reuse_port: bool) -> socket.socket:
+    # With SO_REUSEPORT every shard binds its own socket and the kernel
+    # spreads new connections between them
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((ip, port))
+    listener.listen(1024)
+    return listener
+
+
+class ShardRouter():
+    # Connects the shards of one server. Every shard listens on its own Unix
+    # socket (a localhost port where there are none) and keeps one link to
+    # each of the others, so messages between two shards stay in order.
+    #
+    # Presence is replicated: each shard announces when a user's first
+    # connection logs in and when their last one goes, and keeps a map of
+    # which other shards each user is on. Messages are stored by the shard
+    # that received them and forwarded to the receiver's shards; acks are
+    # sent back to the shard whose writer stored the row, which is
+    # message id % shards
+    def __init__(self, shard: int, shards: int, bus_directory: str, bus_port: int, sessions: Sessions, broker: Broker, user_directory: UserDirectory, groups: Groups, token_manager: TokenManager, sync_timeout: float = 2.0):
+        self.shard = shard
+        self.shards = shards
+        self.bus_directory = bus_directory
+        self.bus_port = bus_port
+        self.broker = broker
+        self.sync_timeout = sync_timeout
+        self.incoming_messages: "IncomingMessages"
+        self.user_directory = user_directory
+        self.groups = groups
+        self.token_manager = token_manager
+        self.running = True
+        self.started: float = time.monotonic()
+
+        self.links: dict[int, socket.socket] = {}
+        self.link_locks: dict[int, Lock] = {index: Lock() for index in range(shards) if index != shard}
+        self.listener: socket.socket
+
+        self.lock = Lock()
+        # username -> {shard: (online, sequence)}, for other shards only
+        self.presence: dict[str, dict[int, tuple[bool, int]]] = {}
+        self.barrier_ids = itertools.count(1)
+        self.barriers: dict[int, tuple[Event, list[int]]] = {}
+
+        sessions.presence = self.presenceChanged
+        user_directory.changed = lambda username: self.broadcast({"type": "user_added", "username": username})
+        groups.changed = lambda group_name: self.broadcast({"type": "group_changed", "group_name": group_name})
+        token_manager.changed = lambda kind, key, value: self.broadcast({"type": "revoked", "kind": kind, "key": key, "value": value})
+
+    def start(self, incoming_messages: "IncomingMessages"):
+        self.incoming_messages = incoming_messages
+        if hasattr(socket, "AF_UNIX"):
+            path: str = self.address(self.shard)
+            if os.path.exists(path):
+                os.remove(path)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(path)
+        else:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.bind(self.address(self.shard))
+        self.listener.listen(self.shards)
+        Thread(target=self.acceptLinks, daemon=True).start()
+
+    def address(self, shard: int) -> str | tuple[str, int]:
+        if hasattr(socket, "AF_UNIX"):
+            return os.path.join(self.bus_directory, f"shard-{shard}.sock")
+        return ("127.0.0.1", self.bus_port + shard)
+
+    def acceptLinks(self):
+        while self.running:
+            try:
+                link, _ = self.listener.accept()
+            except OSError:
+                return
+            Thread(target=self.readLink, args=(link,), daemon=True).start()
+
+    def readLink(self, link: socket.socket):
+        decoder = FrameDecoder()
+        try:
+            while self.running:
+                for message in decoder.recv(link):
+                    try:
+                        self.handle(message)
+                    except Exception:
+                        log.exception("route_failed", kind=message.get("type"))
+        except (OSError, ValueError):
+            pass
+        link.close()
+
+    def handle(self, message: dict):
+        match(message["type"]):
+            case "message":
+                self.incoming_messages.deliverRouted(message["message"])
+            case "group":
+                self.incoming_messages.deliverRoutedGroup(message["message"], message["members"])
+            case "delete":
+                self.broker.ack(message["ids"], message["username"])
+            case "presence":
+                self.updatePresence(message["username"], message["shard"], message["online"], message["sequence"])
+                if message["online"]:
+                    # Whatever this shard stored for the user before it heard
+                    # about the login is committed before their backlog is read
+                    self.broker.sync()
+                    self.send(message["shard"], {"type": "synced", "barrier": message["barrier"]})
+            case "synced":
+                self.synced(message["barrier"])
+            case "user_added":
+                self.user_directory.userAdded(message["username"])
+            case "group_changed":
+                self.groups.invalidate(message["group_name"])
+            case "revoked":
+                self.token_manager.revoked(message["kind"], message["key"], message["value"])
+
+    def send(self, shard: int, message: dict) -> bool:
+        data: bytes = encode(message)
+        with self.link_locks[shard]:
+            link = self.links.get(shard)
+            try:
+                if link is None:
+                    link = self.connect(shard)
+                    self.links[shard] = link
+                link.sendall(data)
+                return True
+            except OSError as e:
+                log.warning("link_failed", shard=shard, error=str(e))
+                self.links.pop(shard, None)
+                if link is not None:
+                    link.close()
+                return False
+
+    def connect(self, shard: int) -> socket.socket:
+        # Shards start together, so a peer may not be listening yet
+        while True:
+            try:
+                link = socket.socket(socket.AF_UNIX if hasattr(socket, "AF_UNIX") else socket.AF_INET, socket.SOCK_STREAM)
+                link.connect(self.address(shard))
+                return link
+            except OSError:
+                link.close()
+                if time.monotonic() - self.started > 10 or not self.running:
+                    raise
+                time.sleep(0.05)
+
+    def broadcast(self, message: dict) -> list[int]:
+        # The shards it reached
+        return [shard for shard in self.link_locks if self.send(shard, message)]
+
+    def presenceChanged(self, username: str, online: bool, sequence: int):
+        # Runs on the thread that logged the user in. A login waits until the
+        # other shards have committed what they stored for the user, so the
+        # backlog read that follows sees it
+        if not online:
+            self.broadcast({"type": "presence", "username": username, "shard": self.shard, "online": False, "sequence": sequence})
+            return
+
+        barrier: int = next(self.barrier_ids)
+        done = Event()
+        # Replies can come back before broadcast returns, so count down from
+        # every peer and take off the ones it could not reach
+        waiting: list[int] = [len(self.link_locks)]
+        with self.lock:
+            self.barriers[barrier] = (done, waiting)
+        reached: list[int] = self.broadcast({"type": "presence", "username": username, "shard": self.shard, "online": True, "sequence": sequence, "barrier": barrier})
+        with self.lock:
+            waiting[0] -= len(self.link_locks) - len(reached)
+            if waiting[0] <= 0:
+                done.set()
+        if not done.wait(self.sync_timeout):
+            log.warning("presence_sync_timeout", username=username)
+        with self.lock:
+            self.barriers.pop(barrier, None)
+
+    def synced(self, barrier: int):
+        with self.lock:
+            entry = self.barriers.get(barrier)
+            if entry is None:
+                return
+            done, waiting = entry
+            waiting[0] -= 1
+            if waiting[0] <= 0:
+                done.set()
+
+    def updatePresence(self, username: str, shard: int, online: bool, sequence: int):
+        with self.lock:
+            shards = self.presence.setdefault(username, {})
+            current = shards.get(shard)
+            if current is None or current[1] < sequence:
+                shards[shard] = (online, sequence)
+
+    def locate(self, username: str) -> list[int]:
+        with self.lock:
+            shards = self.presence.get(username)
+            if not shards:
+                return []
+            return [shard for shard, (online, _) in shards.items() if online]
+
+    def routeMessage(self, message: dict):
+        # Already stored here, so a shard that cannot be reached only delays it
+        # until the receiver's next login
+        for shard in self.locate(message["receiver_username"]):
+            if self.send(shard, {"type": "message", "message": message}):
+                metrics.increment("messages_routed")
+
+    def routeGroupMessage(self, message: dict, members) -> set[str]:
+        # Members that another shard took on; that shard stores the copy for
+        # any of them that have gone by the time it arrives
+        by_shard: dict[int, list[str]] = {}
+        for username in members:
+            if username == message["sender_username"]:
+                continue
+            for shard in self.locate(username):
+                by_shard.setdefault(shard, []).append(username)
+
+        routed: set[str] = set()
+        for shard, usernames in by_shard.items():
+            if self.send(shard, {"type": "group", "message": message, "members": usernames}):
+                routed.update(usernames)
+                metrics.increment("messages_routed", len(usernames))
+        return routed
+
+    def removeMessages(self, message_ids: list[int], username: str):
+        by_shard: dict[int, list[int]] = {}
+        for message_id in message_ids:
+            by_shard.setdefault(message_id % self.shards, []).append(message_id)
+        for shard, ids in by_shard.items():
+            # Deleting here still works once the other shard has committed the row
+            if shard == self.shard or not self.send(shard, {"type": "delete", "ids": ids, "username": username}):
+                self.broker.ack(ids, username)
+
+    def stop(self):
+        self.running = False
+        try:
+            self.listener.close()
+        except AttributeError:
+            pass
+        for shard in self.link_locks:
+            with self.link_locks[shard]:
+                link = self.links.pop(shard, None)
+                if link is not None:
+                    link.close()
+        if hasattr(socket, "AF_UNIX"):
+            try:
+                os.remove(self.address(self.shard))
+            except OSError:
+                pass
+
+
+def runShard(ip: str, port: int, shard: int, shards: int, listen_socket: socket.socket | None, options: dict, stop):
+    # Child process: one complete Server, sharing the database and port with the others
+    from Server import Server
+    server = Server(ip, port, shard=shard, shards=shards, listen_socket=listen_socket, **options)
+    stop.wait()
+    server.closeServer()
+    # The thread engine's accept() is not woken by close
+    os._exit(0)
+
+
+class ShardedServer():
+    # Runs one Server per shard, each in its own process, so delivery and
+    # protocol work are spread over several cores instead of sharing one GIL.
+    # Where SO_REUSEPORT is missing the shards accept on one socket inherited
+    # from this process, which needs fork
+    def __init__(self, ip: str, port: int, shards: int | None = None, bus_directory: str = "shards", bus_port: int | None = None, **options):
+        self.shards: int = shards or os.cpu_count() or 1
+        # Created here once, so the shards do not race to migrate the
+        # database or to generate the token key
+        database = Database()
+        database.initDatabase()
+        loadSecret(database)
+        database.close()
+        os.makedirs(bus_directory, exist_ok=True)
+
+        listen_socket: socket.socket | None = None
+        if hasattr(socket, "SO_REUSEPORT"):
+            context = multiprocessing.get_context()
+        elif "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+            listen_socket = openListener(ip, port, False)
+        else:
+            raise RuntimeError("Sharding needs SO_REUSEPORT or fork")
+
+        options = {**options, "bus_directory": bus_directory, "bus_port": port + 1000 if bus_port is None else bus_port}
+        self.stop = context.Event()
+        self.processes = [context.Process(target=runShard, args=(ip, port, shard, self.shards, listen_socket, options, self.stop)) for shard in range(self.shards)]
+        for process in self.processes:
+            process.start()
+        if listen_socket is not None:
+            listen_socket.close()
+
+    def closeServer(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join(10)
+            if process.is_alive():
+                process.kill()
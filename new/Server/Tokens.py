@@ -0,0 +1,101 @@
+from threading import Lock
+from typing import Callable
+import hashlib
+import base64
+import hmac
+import json
+import secrets
+import time
+
+from Database import Database, DatabaseWriter
+
+SECRET_KEY = "token_secret"
+TOKEN_TTL = 7 * 24 * 60 * 60
+
+
+def encodeSegment(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def decodeSegment(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def loadSecret(database: Database) -> bytes:
+    # Created on first use and then shared by every process on the database
+    secret: str | None = database.getSetting(SECRET_KEY)
+    if secret is None:
+        secret = secrets.token_hex(32)
+        database.setSetting(SECRET_KEY, secret)
+    return bytes.fromhex(secret)
+
+
+class TokenManager():
+    # Session tokens are "<payload>.<signature>": the payload carries the
+    # username, a token id and issue/expiry times, signed with HMAC-SHA256.
+    # Checking one is a hash and a few dict lookups, with no database or KDF.
+    # The key and revocations live in the database so tokens survive restarts
+    def __init__(self, database: Database, database_writer: DatabaseWriter, ttl: int = TOKEN_TTL):
+        self.database_writer = database_writer
+        self.ttl = ttl
+        self.lock = Lock()
+        # Called with (kind, key, value) after each revocation, for other shards
+        self.changed: Callable[[str, str, int], None] | None = None
+
+        self.secret: bytes = loadSecret(database)
+        self.revoked_tokens: dict[str, int] = database.getRevokedTokens(int(time.time()))
+        # Every token a user was issued up to this time (in milliseconds) is revoked
+        self.revoked_users: dict[str, int] = database.getRevokedUsers()
+
+    def issue(self, username: str) -> str:
+        payload: bytes = json.dumps({
+            "username": username,
+            "id": secrets.token_hex(8),
+            "issued": time.time_ns() // 1000000,
+            "expires": int(time.time()) + self.ttl
+        }, separators=(",", ":")).encode()
+        return f"{encodeSegment(payload)}.{encodeSegment(self.sign(payload))}"
+
+    def verify(self, token: str) -> dict | None:
+        # The token's claims, or None if it is forged, expired or revoked
+        try:
+            payload_segment, signature_segment = token.split(".")
+            payload: bytes = decodeSegment(payload_segment)
+            if not hmac.compare_digest(decodeSegment(signature_segment), self.sign(payload)):
+                return None
+            claims: dict = json.loads(payload)
+        except (ValueError, AttributeError):
+            return None
+
+        if claims["expires"] <= time.time():
+            return None
+        with self.lock:
+            if claims["id"] in self.revoked_tokens:
+                return None
+            if claims["issued"] <= self.revoked_users.get(claims["username"], -1):
+                return None
+        return claims
+
+    def revoke(self, claims: dict):
+        self.revoked("token", claims["id"], claims["expires"])
+        self.database_writer.revokeToken(claims["id"], claims["expires"])
+        if self.changed is not None:
+            self.changed("token", claims["id"], claims["expires"])
+
+    def revokeUser(self, username: str):
+        revoked_at: int = time.time_ns() // 1000000
+        self.revoked("user", username, revoked_at)
+        self.database_writer.revokeUser(username, revoked_at)
+        if self.changed is not None:
+            self.changed("user", username, revoked_at)
+
+    def revoked(self, kind: str, key: str, value: int):
+        # Memory only; the caller or the shard that revoked it writes the row
+        with self.lock:
+            if kind == "token":
+                self.revoked_tokens[key] = value
+            else:
+                self.revoked_users[key] = max(value, self.revoked_users.get(key, -1))
+
+    def sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()